@@ -13,9 +13,58 @@ import sys
 sys.path.append('..')
 from utils.acquisition_functions import Custom_LogEI
 from utils import normalize_vector, denormalize_vector
+from utils.history import HistoryJournal, HistoryBuffer, load_history
 #torch.set_default_dtype(torch.float64)
 from time import time
 import h5py
+from contextlib import nullcontext
+
+class SuccessiveHalving():
+    '''Fidelity scheduler for a batch of candidates (successive halving).
+
+    All the candidates are evaluated with budgets[0] muons; at every rung the best 1/eta
+    of them (at least min_promoted, and only those below `threshold` if given) are promoted
+    to the next budget. The last budget is the full fidelity (n_samples = 0 is the whole
+    muon sample). Every evaluation is kept in records as (phi, y, n_samples, rung).'''
+    def __init__(self, budgets:tuple, eta:int = 3, min_promoted:int = 1):
+        self.budgets = tuple(budgets)
+        self.eta = eta
+        self.min_promoted = min_promoted
+        self.records = []
+        self.last_fidelity = None
+        self.stats = {f'rung_{r}': 0 for r in range(len(self.budgets))}
+    @classmethod
+    def geometric(cls, min_samples:int, max_samples:int = 0, eta:int = 3, **kwargs):
+        '''Budgets min_samples * eta^k below max_samples, then max_samples.'''
+        budgets = [min_samples]
+        while max_samples > 0 and budgets[-1] * eta < max_samples: budgets.append(budgets[-1] * eta)
+        return cls(budgets + [max_samples], eta, **kwargs)
+    def evaluate(self, true_model, phi, n_samples:int):
+        '''true_model(phi) with n_samples muons, in its own common-random-numbers context.'''
+        previous = true_model.n_samples
+        true_model.n_samples = n_samples
+        crn = getattr(true_model, 'common_random_numbers', None)
+        try:
+            with (crn() if crn is not None else nullcontext()):
+                return torch.as_tensor(true_model(phi)).reshape(-1, 1).cpu()
+        finally: true_model.n_samples = previous
+    def __call__(self, true_model, phi, threshold = None):
+        '''Loss (N,1) of each candidate at the highest rung it reached, and that rung (N,).'''
+        phi = phi.reshape(-1, phi.size(-1))
+        y = torch.empty(phi.size(0), 1)
+        rung = torch.zeros(phi.size(0), dtype=torch.long)
+        active = torch.arange(phi.size(0))
+        for r, n_samples in enumerate(self.budgets):
+            y[active] = self.evaluate(true_model, phi[active], n_samples).to(y.dtype)
+            rung[active] = r
+            self.stats[f'rung_{r}'] += len(active)
+            self.records.extend((phi[i].cpu(), y[i].clone(), n_samples, r) for i in active.tolist())
+            if r + 1 == len(self.budgets): break
+            active = active[y[active].flatten().argsort()[:max(self.min_promoted, len(active) // self.eta)]]
+            if threshold is not None: active = active[y[active].flatten() < threshold]
+            if len(active) == 0: break
+        self.last_fidelity = [self.budgets[r] for r in rung.tolist()]
+        return y, rung
 
 class OptimizerClass():
     '''Mother class for optimizers'''
@@ -32,8 +81,7 @@ class OptimizerClass():
         self.true_model = true_model
         if resume:
             if history == (): 
-                with open(join(outputs_dir,'history.pkl'), "rb") as f:
-                    self.history = load(f)
+                self.history = load_history(outputs_dir)
         else:
             self.history = history
         #self.model = self.surrogate_model_class(*self.history).to(self.device)
@@ -44,6 +92,9 @@ class OptimizerClass():
         self.bounds = bounds.to(self.device)
         self.wandb = WandB
         self.outputs_dir = outputs_dir
+        self.fidelity = None
+        self.journal = None
+        self.censored = [] # per row appended to the history in this run: early-stopped estimate
     def loss(self,x = None, y = None):
         return y
     def fit_surrogate_model(self,**kwargs):
@@ -54,9 +105,16 @@ class OptimizerClass():
         if y.dim() == 0:
             y = y.reshape(-1, 1)
         phi,y = phi.reshape(-1,phi.shape[-1]).cpu(), y.reshape(-1,y.shape[-1]).cpu()
-        if len(self.history) == 0:
-            self.history = (phi,y)
-        else: self.history = (torch.cat([self.history[0], phi]),torch.cat([self.history[1], y]))
+        if not isinstance(self.history, HistoryBuffer): # amortized O(1) appends from now on
+            self.history = HistoryBuffer(*self.history)
+        self.history.append(phi,y)
+        self.censored.extend(self.last_censored(phi.size(0)))
+    def last_censored(self, n:int):
+        '''Censored flags of the n rows of the last true model call (all False if that call
+        was not these n rows, or the model does not stop early).'''
+        censored = torch.as_tensor(getattr(self.true_model, 'last_censored', []), dtype=torch.bool).view(-1)
+        if censored.numel() != n: return [False] * n
+        return censored.tolist()
     def n_iterations(self):
         return self._i
     def n_calls(self):
@@ -73,10 +131,36 @@ class OptimizerClass():
         return self.history
     def optimization_iteration(self):
         return torch.empty(1),self.loss(torch.empty(1))
+    def open_journal(self):
+        '''History journal of outputs_dir (see HistoryJournal), compacted to the current history
+        if it does not hold exactly these evaluations (new run, or journal of another run).'''
+        self.journal = HistoryJournal(self.outputs_dir)
+        last = self.journal.last_phi()
+        in_sync = len(self.journal) == self.n_calls() and (last is None or torch.equal(
+                  torch.as_tensor(last, dtype=self.history[0].dtype).view(-1), self.history[0][-1].cpu().view(-1)))
+        if not in_sync: self.journal.snapshot(self.history[:2])
+        return self.journal
+    def save_history(self, wall_time:float = None, seed = None):
+        '''Append the evaluations of the last iteration to the journal, one fsync'd record each,
+        compacting it into a snapshot every journal.snapshot_every records.'''
+        if self.journal is None: self.open_journal()
+        n_new = self.n_calls() - len(self.journal)
+        if n_new <= 0: return
+        fidelity = getattr(self.fidelity, 'last_fidelity', None)
+        if fidelity is None or len(fidelity) != n_new: fidelity = getattr(self.true_model, 'n_samples', None)
+        censored = self.censored[-n_new:] if len(self.censored) >= n_new else [False] * n_new
+        self.journal.append(self.history[0][-n_new:], self.history[1][-n_new:], fidelity, wall_time, seed, censored)
+        if self.journal.pending >= self.journal.snapshot_every: self.journal.snapshot(self.history[:2])
+    def common_random_numbers(self):
+        '''CRN context of the true model, so all the candidates of an iteration see the same muons and seeds.
+        With a fidelity scheduler, every rung opens its own context instead.'''
+        crn = getattr(self.true_model, 'common_random_numbers', None) if self.fidelity is None else None
+        return crn() if crn is not None else nullcontext()
     def run_optimization(self,
                          save_optimal_phi:bool = True,
                          save_history:bool = True,
                          **convergence_params):
+        if save_history: self.open_journal()
         with wandb.init(reinit = True,**self.wandb) as wb, tqdm(initial = self._i,total=convergence_params['max_iter']) as pbar:
             for min_loss,phi,y in zip(self.loss(*self.history).cummin(0).values,*self.history[:2]):
                 log = {'loss':self.loss(phi,y).item(), 
@@ -87,7 +171,13 @@ class OptimizerClass():
                 #    log['phi_%d'%i] = p
                 wb.log(log)
             while not self.stopping_criterion(**convergence_params):
-                phi,loss = self.optimization_iteration()
+                if getattr(self.true_model, 'early_stopping', False):
+                    self.true_model.stop_threshold = self.get_optimal()[1].item()
+                t_iter = time()
+                with self.common_random_numbers():
+                    phi,loss = self.optimization_iteration()
+                    seed = getattr(self.true_model, '_crn_seed', None)
+                if seed is None: seed = getattr(self.true_model, 'seed', None)
                 if (loss<min_loss.to(self.device)):
                     min_loss = loss
                     if save_optimal_phi:
@@ -100,12 +190,25 @@ class OptimizerClass():
                         'min_loss':min_loss.item()}
                 if hasattr(self, 'trust_radius'):
                     log['trust_radius'] = self.trust_radius
+                if getattr(self.true_model, 'cache', None) is not None:
+                    log.update({f'cache_{k}': v for k, v in self.true_model.cache.stats().items()})
+                if getattr(self.true_model, 'electrical_costs', None) is not None:
+                    log['electrical_cost_hit_rate'] = self.true_model.electrical_costs.stats()['hit_rate']
+                if getattr(self.true_model, 'early_stopping', False):
+                    log.update({f'early_stop_{k}': v for k, v in self.true_model.early_stop_stats.items()})
+                    log['censored_in_history'] = sum(self.censored)
+                if getattr(self.true_model, '_chunk_executor', None) is not None:
+                    log.update({f'chunk_{k}': v for k, v in self.true_model.chunk_executor.stats.items()})
+                if self.fidelity is not None:
+                    log.update({f'fidelity_{k}': v for k, v in self.fidelity.stats.items()})
+                if getattr(self.true_model, 'gate_stats', None) is not None:
+                    log.update({f'gate_{k}': v for k, v in self.true_model.gate_stats.items()})
                 if save_history:
-                    with open(join(self.outputs_dir,f'history.pkl'), "wb") as f:
-                        dump(self.history, f)
+                    self.save_history(time() - t_iter, seed)
                 wb.log(log)
                 self._i += 1
         wb.finish()
+        if self.journal is not None: self.journal.close()
         return phi,loss
 
     
@@ -220,15 +323,23 @@ class LGSO(OptimizerClass):
         l.backward()
         self.phi_optimizer.step()
         return self._current_phi
+    def open_journal(self):
+        '''LGSO histories also hold the muons and per-muon outputs: they stay in history.pkl.'''
+        return None
+    def save_history(self, wall_time:float = None, seed = None):
+        with open(join(self.outputs_dir,'history.pkl'), "wb") as f:
+            dump(self.history, f)
     def update_history(self,phi,y,x):
         phi,y,x = phi.cpu(),y.cpu(),x.cpu()
         phi = phi.view(-1,phi.size(-1))
         phi = phi.repeat(y.size(0), 1)
+        if not isinstance(self.history, HistoryBuffer):
+            self.history = HistoryBuffer(*self.history)
         if len(self.history) ==0: 
-            self.history = phi,y.view(-1,y.size(-1)),x.view(-1,x.size(-1))
+            self.history.append(phi,y.view(-1,y.size(-1)),x.view(-1,x.size(-1)))
         else:
             phi,y,x = phi, y.reshape(-1,self.history[1].shape[1]).to(phi.device),x.reshape(-1,self.history[2].shape[1]).to(phi.device)
-            self.history = (torch.cat([self.history[0], phi]),torch.cat([self.history[1], y]),torch.cat([self.history[2], x]))
+            self.history.append(phi,y,x)
 
 class LCSO(OptimizerClass):
     def __init__(self,true_model,
@@ -964,8 +1075,7 @@ class AnalyticalOptimizer(OptimizerClass):
         self.phi_optimizer = torch.optim.SGD([self._current_phi],lr=initial_lr)
         self.rhos = []
         if resume: 
-            with open(join(outputs_dir,'history.pkl'), "rb") as f:
-                self.history = load(f)
+            self.history = load_history(outputs_dir)
         else: self.simulate_and_update(initial_phi)
     @property
     def current_phi(self):
@@ -1170,6 +1280,7 @@ class BayesianOptimizer(OptimizerClass):
                  reduce_bounds:int = 4000,
                  outputs_dir = 'outputs',
                  multi_fidelity:bool = False,
+                 fidelity:SuccessiveHalving = None,
                  resume:bool = False):
         
         super().__init__(true_model,
@@ -1182,9 +1293,7 @@ class BayesianOptimizer(OptimizerClass):
                  resume = resume)
         if len(history)==0:
             if resume: 
-                with open(join(outputs_dir,'history.pkl'), "rb") as f:
-                    self.history = load(f)
-                    self.history = tuple(tensor.to(torch.get_default_dtype()) for tensor in self.history)
+                self.history = tuple(tensor.to(torch.get_default_dtype()) for tensor in load_history(outputs_dir))
                 self._i = len(self.history[0])
             else: 
                 self.history = (initial_phi.cpu().view(-1,initial_phi.size(0)),
@@ -1196,6 +1305,9 @@ class BayesianOptimizer(OptimizerClass):
         self.model_scheduler = model_scheduler
         self._iter_reduce_bounds = reduce_bounds
         self.multi_fidelity = multi_fidelity
+        if fidelity is None and multi_fidelity: # sampled muons first, the whole sample for promising candidates
+            fidelity = SuccessiveHalving((true_model.n_samples, 0))
+        self.fidelity = fidelity
         self.trust_radius = 1.0
         self.bounds = self.bounds.cpu()
         if resume: 
@@ -1227,12 +1339,9 @@ class BayesianOptimizer(OptimizerClass):
         t1 = time()
         phi = self.get_new_phi().cpu()
         print('acquisition function optimization time: ', time()-t1)
-        y = self.true_model(phi)
-        if self.multi_fidelity and y < self.history[1][0] * 10:
-            n_samples = self.true_model.n_samples
-            self.true_model.n_samples = 0
-            y = self.true_model(phi)
-            self.true_model.n_samples = n_samples
+        if self.fidelity is not None:
+            y, _ = self.fidelity(self.true_model, phi, threshold = self.history[1][0] * 10)
+        else: y = self.true_model(phi)
         self.update_history(phi,y)
         y,idx = self.loss(phi,y).flatten().min(0)
         return phi[idx],y
@@ -1404,7 +1513,10 @@ class PowellOptimizer(OptimizerClass):
 
         # --- History Initialization (same as before) ---
         loaded_history = ()
-        if resume:
+        if resume and HistoryJournal.exists(outputs_dir):
+            loaded_history = load_history(outputs_dir)
+            self._current_directions = None # directions are not journaled
+        elif resume:
             history_path = join(outputs_dir,'history.pkl')
             try:
                 with open(history_path, "rb") as f:
@@ -1620,6 +1732,7 @@ class CMAESOptimizer(OptimizerClass):
                  history: tuple = (),
                  WandB: dict = {'name': 'CMA-ES'},
                  outputs_dir = 'outputs',
+                 fidelity: SuccessiveHalving = None,
                  resume: bool = False):
         
         super().__init__(true_model,
@@ -1633,9 +1746,7 @@ class CMAESOptimizer(OptimizerClass):
 
         if len(history)==0:
             if resume: 
-                with open(join(outputs_dir,'history.pkl'), "rb") as f:
-                    self.history = load(f)
-                    self.history = tuple(tensor.to(torch.get_default_dtype()) for tensor in self.history)
+                self.history = tuple(tensor.to(torch.get_default_dtype()) for tensor in load_history(outputs_dir))
                 self._i = len(self.history[0])
             else: 
                 self.history = (initial_phi.cpu().view(-1,initial_phi.size(0)),
@@ -1643,6 +1754,7 @@ class CMAESOptimizer(OptimizerClass):
                 self._i = 0
 
         self.N = self.bounds.shape[1] 
+        self.fidelity = fidelity
 
         if initial_phi is not None:
             self.xmean = initial_phi.to(self.device).view(-1)
@@ -1721,19 +1833,20 @@ class CMAESOptimizer(OptimizerClass):
         offspring_norm = offspring_norm.clamp(0.0,1.0)
         offspring = denormalize_vector(offspring_norm, self.bounds).to(self.device)
         
-        scores = []
-        for i in range(self.lam):
-            val = self.true_model(offspring[i])
-            scores.append(val)
-            
-        scores = torch.tensor(scores, device=self.device).view(-1, 1)
+        # Whole generation in one call, so batched problems dispatch it at once
+        if self.fidelity is not None:
+            scores, rung = self.fidelity(self.true_model, offspring)
+            scores = scores.to(self.device)
+        else: scores = torch.as_tensor(self.true_model(offspring), device=self.device).view(-1, 1)
         
         # Update history for logging
         self.update_history(offspring, scores)
         
         # --- 3. Update (Tell) ---
         # Sort by fitness and compute weighted mean into xmean
-        sorted_indices = torch.argsort(scores.flatten())
+        if self.fidelity is not None: # candidates that reached a higher fidelity rank first
+            sorted_indices = torch.as_tensor(np.lexsort((scores.flatten().cpu().numpy(), -rung.numpy())), device=self.device)
+        else: sorted_indices = torch.argsort(scores.flatten())
         
         # Select top mu
         best_indices = sorted_indices[:self.mu]
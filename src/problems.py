@@ -5,17 +5,34 @@ import pickle
 import sys
 import numpy as np
 import os
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 PROJECTS_DIR = os.getenv('PROJECTS_DIR', '~/projects')
 sys.path.insert(1, os.path.join(PROJECTS_DIR,'BlackBoxOptimization'))
-from utils import split_array, split_array_idx, get_split_indices, compute_solid_volume, make_index, apply_index, uniform_sample
+from utils import split_array, split_array_idx, split_indices_parallel, get_split_indices, missing_ranges, compute_prismatoid_volume, make_index, apply_index, uniform_sample, stitch_field_maps, fn_pen
+from utils.parallel import EvaluationPool, SharedMuonBuffer, ReturnFileWatcher, LocalStarClient, ChunkExecutor, AdaptiveChunker, attach_muons
+from utils.muons import MuonSampler, MuonStore, gather_rows
+from utils.cache import EvaluationCache, FieldMapStore, MemoLRU, hash_key, array_fingerprint
 import logging
 import json
 from functools import partial
+from contextlib import nullcontext, contextmanager
+import shutil
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 logging.basicConfig(level=logging.WARNING)
 import time
 #torch.set_default_dtype(torch.float64)
 
+def _cached_stochastic(cache, key, fn, device):
+    '''cache.get_or_compute for an evaluation fn() drawing from the torch RNG, so that caching does
+    not freeze its noise: the RNG state is part of the key (only a replay from the same state hits),
+    and a hit restores the state fn left, so the random stream goes on as if fn had run again.'''
+    if torch.device(device).type != 'cpu': return fn()  # the CUDA generators are not tracked
+    value, state = cache.get_or_compute(hash_key(key, torch.get_rng_state()), lambda: (fn(), torch.get_rng_state()))
+    torch.set_rng_state(state)
+    return value
+
 class RosenbrockProblem:
     """
     Represents the classic N-dimensional Rosenbrock function.
@@ -101,11 +118,13 @@ class Rosenbrock_stochastic_hits(RosenbrockProblem):
     def __init__(self, dim: int = 2, n_samples: int = 100_000,
                  phi_bounds=((-2.0, 2.0)),
                  x_bounds=(-3.0, 3.0),
-                 reduction='mean'):
+                 reduction='mean',
+                 cache:EvaluationCache = None):
         super().__init__(dim=dim, phi_bounds=phi_bounds)
         self.x_bounds = x_bounds
         self.n_samples = n_samples
         self.reduction = reduction
+        self.cache = cache
         self.offset = 0.01  # To avoid zero probabilities
         
         self.y_max = self._find_max_value()
@@ -196,6 +215,14 @@ class Rosenbrock_stochastic_hits(RosenbrockProblem):
         return (y > 0).int()
 
     def __call__(self, phi, x=None):
+        if phi.dim() > 1 and phi.size(0) > 1: # no batched simulation: one candidate at a time
+            return torch.stack([torch.as_tensor(self(p, x)).view(-1) for p in phi])
+        if x is None and self.cache is not None and self.reduction != 'none':
+            key = hash_key(type(self).__name__, phi, self.n_samples, self.x_bounds, self.reduction, self.offset)
+            return _cached_stochastic(self.cache, key, lambda: self._evaluate(phi), phi.device)
+        return self._evaluate(phi, x)
+
+    def _evaluate(self, phi, x=None):
         if x is None:
             x = self.sample_x(device=phi.device)
             
@@ -387,11 +414,13 @@ class ThreeHump_stochastic_hits(ThreeHump):
     def __init__(self, n_samples:int = 100_000, 
                  phi_bounds = ((-2.3,-2),(2.3,2)), 
                  x_bounds = (-3,3),
-                 reduction = 'mean'):
+                 reduction = 'mean',
+                 cache:EvaluationCache = None):
         super().__init__(phi_bounds=phi_bounds)
         self.x_bounds = x_bounds
         self.n_samples = n_samples
         self.reduction = reduction
+        self.cache = cache
         self.offset = 0.01  # To avoid zero probabilities
         self.y_max = self._find_max_value()
         self.normalize_factor = 1.0
@@ -455,6 +484,14 @@ class ThreeHump_stochastic_hits(ThreeHump):
         return hits
 
     def __call__(self, phi, x=None):
+        if phi.dim() > 1 and phi.size(0) > 1: # no batched simulation: one candidate at a time
+            return torch.stack([torch.as_tensor(self(p, x)).view(-1) for p in phi])
+        if x is None and self.cache is not None and self.reduction != 'none':
+            key = hash_key(type(self).__name__, phi, self.n_samples, self.x_bounds, self.reduction, self.offset)
+            return _cached_stochastic(self.cache, key, lambda: self._evaluate(phi), phi.device)
+        return self._evaluate(phi, x)
+
+    def _evaluate(self, phi, x=None):
         if x is None:
             x = self.sample_x()
         y = self.simulate(phi, x)
@@ -556,11 +593,13 @@ class HelicalValley_stochastic_hits(HelicalValleyProblem):
     def __init__(self, n_samples: int = 100_000,
                  phi_bounds=((-10.0, 10.0)),
                  x_bounds=(-5.0, 5.0),
-                 reduction='mean'):
+                 reduction='mean',
+                 cache:EvaluationCache = None):
         super().__init__(dim=3, phi_bounds=phi_bounds)
         self.x_bounds = x_bounds
         self.n_samples = n_samples
         self.reduction = reduction
+        self.cache = cache
         self.offset = 0.01  # To avoid zero probabilities
         
         self.y_max = self._find_max_value()
@@ -648,6 +687,14 @@ class HelicalValley_stochastic_hits(HelicalValleyProblem):
         return (y>0).int()
 
     def __call__(self, phi, x=None):
+        if phi.dim() > 1 and phi.size(0) > 1: # no batched simulation: one candidate at a time
+            return torch.stack([torch.as_tensor(self(p, x)).view(-1) for p in phi])
+        if x is None and self.cache is not None and self.reduction != 'none':
+            key = hash_key(type(self).__name__, phi, self.n_samples, self.x_bounds, self.reduction, self.offset)
+            return _cached_stochastic(self.cache, key, lambda: self._evaluate(phi), phi.device)
+        return self._evaluate(phi, x)
+
+    def _evaluate(self, phi, x=None):
         if x is None:
             x = self.sample_x(device=phi.device)
             
@@ -663,6 +710,90 @@ class HelicalValley_stochastic_hits(HelicalValleyProblem):
             return y.float().sum()
         return y
 
+def _run_workload(run_fn, workload, **kwargs):
+    '''Pool worker: simulate one (muon chunk, geometry, field map) workload.'''
+    chunk, params, field_map_file = workload[:3]
+    if len(workload) > 3: kwargs['seed'] = workload[3]
+    if isinstance(chunk, tuple): chunk = attach_muons(*chunk)
+    kwargs['field_map_file'] = field_map_file
+    return run_fn(chunk, params = params, **kwargs)
+
+class MuonLossKernel():
+    '''Hit selection and loss of the simulation outputs. Plain attributes only, so it can be
+    sent to the pool workers, which then return partial sums instead of the output arrays.'''
+    MUON = 13
+    def __init__(self, x_margin, y_margin, sensitive_plane:dict, cut_P = None, loss_fn = 'continuous', reduction = 'mean'):
+        self.x_margin = x_margin
+        self.y_margin = y_margin
+        self.plane_position = sensitive_plane['position']
+        self.plane_dz = sensitive_plane['dz']
+        self.cut_P = cut_P
+        self.loss_fn = loss_fn
+        self.reduction = reduction
+    def is_hit(self, px, py, pz, x, y, z, particle):
+        mask = (torch.abs(x) <= self.x_margin) & (torch.abs(y) <= self.y_margin) 
+        mask = mask & (torch.abs(z - self.plane_position) <= self.plane_dz)
+        mask = mask & (torch.abs(particle).to(torch.int)==self.MUON)
+        if self.cut_P is not None: 
+            p = torch.sqrt(px**2+py**2+pz**2)
+            mask = mask & p.ge(self.cut_P)
+        return mask.to(torch.bool)
+    def continuous_loss(self, px, py, pz, x, y, z, particle, weight=None):
+        if x.numel() == 0 or x.isnan().all():
+            return torch.tensor(0.0, device=x.device)
+        charge = -1 * torch.sign(particle)
+        mask = self.is_hit(px, py, pz, x, y, z, particle).to(torch.bool)
+        loss = torch.zeros_like(x)
+        loss[mask] = torch.sqrt(1 + (charge[mask] * x[mask] - self.x_margin) / (2 * self.x_margin))
+        return loss
+    def __call__(self, px, py, pz, x, y, z, particle, weight=None):
+        if self.loss_fn == 'continuous':
+            loss =  self.continuous_loss(px,py,pz,x,y,z,particle, weight)
+        elif self.loss_fn == 'hits':
+            loss = self.is_hit(px, py, pz, x, y, z, particle).to(torch.float)
+        if (self.reduction != 'none') and (weight is not None):
+            loss = weight * loss
+        return loss
+    def partials(self, outputs):
+        '''(loss sum, output weight sum, number of hits, number of outputs) of (8, n) outputs.'''
+        outputs = torch.as_tensor(outputs, dtype=torch.get_default_dtype())
+        if outputs.numel() == 0: return torch.zeros(4)
+        hits = self.is_hit(*outputs[:7])
+        return torch.stack([self(*outputs).sum(), outputs[7].sum(),
+                            hits.sum().to(outputs.dtype), torch.tensor(outputs.size(1), dtype=outputs.dtype)]).cpu()
+
+def _reseed_workload(base_seed, workload, attempt):
+    '''Retry of a failed workload, with a fresh simulation seed.'''
+    seed = workload[3] if len(workload) > 3 else base_seed
+    if seed is None: seed = np.random.randint(2**31)
+    return tuple(workload[:3]) + (int(seed) + 7919 * attempt,)
+
+def _run_workload_reduced(run_fn, kernel, workload, **kwargs):
+    '''Pool worker: simulate one workload and return only the loss partials of its outputs.'''
+    result = np.asarray(_run_workload(run_fn, workload, **kwargs))
+    if result.size == 0: return torch.zeros(4)
+    return kernel.partials(result.T)
+
+def _load_muon_range(muons_file, start, stop):
+    if muons_file.endswith('.h5'):
+        with h5py.File(muons_file, 'r') as f:
+            return np.stack([f[feat][start:stop] for feat in ["px", "py", "pz", "x", "y", "z", "pdg", "weight"]], axis=1).astype(np.float32)
+    return MuonSampler(muons_file).array[start:stop]
+
+def _cluster_task(run_fn, kernel, muons_file, run_kwargs, phi, idx, file = None):
+    '''Local cluster task: simulate muons [start, stop) of the muon file for one geometry.
+    Returns the weighted loss of each output muon.'''
+    muons = np.asarray(_load_muon_range(file if isinstance(file, str) else muons_file, *idx), dtype=np.float32)
+    result = np.asarray(run_fn(muons, params = np.asarray(phi).reshape(-1, 15), **run_kwargs))
+    if result.size == 0: return np.zeros(0, dtype=np.float32)
+    return kernel(*torch.as_tensor(result.T, dtype=torch.get_default_dtype())).numpy()
+
+def _concat_chunks(results):
+    '''Per-muon values of every chunk as one flat tensor (chunks return arrays of different lengths).'''
+    results = [torch.as_tensor(np.asarray(r), dtype=torch.get_default_dtype()).reshape(-1) for r in results]
+    if len(results) == 0: return torch.zeros(0)
+    return torch.cat(results)
+
 class ShipMuonShield():
 
     idx_mag = {0: 'Z_gap[cm]', 1: 'Z_len[cm]',
@@ -847,7 +978,28 @@ class ShipMuonShield():
                 parallel:bool = False,
                 use_B_goal:bool = True,
                 cost_as_constraint:bool = False,
-                reduction:str = 'mean'
+                reduction:str = 'mean',
+                cache_dir:str = None,
+                cache_max_bytes:int = 2**30,
+                fields_dir:str = None,
+                fields_max_bytes:int = 20*2**30,
+                field_slabs:bool = False,
+                electrical_cost_memo:int = 4096,
+                electrical_cost_file:str = None,
+                subset_seed:int = None,
+                early_stopping:bool = False,
+                early_stop_waves:int = 8,
+                early_stop_z:float = 3.0,
+                sampling:str = 'uniform',
+                strata:tuple = (8, 4),
+                strata_pilot:int = 0,
+                crn:bool = False,
+                straggler_factor:float = None,
+                chunking:str = 'static',
+                chunk_time:float = 10.0,
+                chunk_timeout:float = None,
+                chunk_retries:int = 2,
+                chunk_save_interval:float = 30.0
                  ) -> None:
         
         self.x_margin = x_margin
@@ -878,6 +1030,34 @@ class ShipMuonShield():
         self.use_diluted = use_diluted
         self.parallel = parallel
         self.cost_as_constraint = cost_as_constraint    
+        self.cache = EvaluationCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+        self.field_maps = FieldMapStore(fields_dir, fields_max_bytes) if fields_dir is not None else None
+        self.subset_seed = subset_seed
+        self.crn = crn
+        self.straggler_factor = straggler_factor
+        assert chunking in ('adaptive', 'static'), f'Unknown chunking {chunking}'
+        self.chunker = AdaptiveChunker(cores, chunk_time) if chunking == 'adaptive' else None
+        self.chunk_timeout = chunk_timeout
+        self.chunk_retries = chunk_retries
+        self.chunk_save_interval = chunk_save_interval
+        self._partial_keys = []
+        self._crn_muons = self._crn_key = self._crn_seed = None
+        assert sampling in ('uniform', 'stratified'), f'Unknown sampling {sampling}'
+        self.sampling = sampling
+        self.strata = tuple(strata)
+        self.strata_pilot = strata_pilot
+        self._strata_version = 0  # pilot runs so far, see pilot_strata
+        self.early_stopping = early_stopping
+        self.early_stop_waves = early_stop_waves
+        self.early_stop_z = early_stop_z
+        self.stop_threshold = None  # set by the optimizer, e.g. to the incumbent loss
+        self.last_censored = torch.zeros(0, dtype=torch.bool)  # per row of the last call: stopped early
+        self.early_stop_stats = {'evaluations': 0, 'censored': 0, 'waves_saved': 0}
+        self._muon_sampler = None
+        self._sample = None  # (identity, muons) of the last deterministic sample, see sample_x
+        self.gate_stats = {'candidates': 0, 'saved_simulations': 0}
+        self.electrical_costs = MemoLRU(electrical_cost_memo, electrical_cost_file)
+        self.field_slabs = FieldMapStore(os.path.join(fields_dir, 'slabs'), fields_max_bytes) if (field_slabs and fields_dir is not None) else None
 
         key = None
         if initial_phi is not None:
@@ -906,18 +1086,91 @@ class ShipMuonShield():
         self.run_magnet = get_field
         self.resol = RESOL_DEF
         self.fields_file = fields_file
+        self._pool = None
+        self._shared_muons = None
+        self._shared_source = None
+        self._shared_key = None
+        self._chunk_executor = None
+
+    @contextmanager
+    def common_random_numbers(self, seed:int = None):
+        '''Common random numbers: inside the context every evaluation uses the same muon subset
+        and the same per-chunk simulation seeds, so differences between candidates are not
+        dominated by sampling noise. No-op if crn is disabled or a context is already active.'''
+        if not self.crn or self._crn_muons is not None:
+            yield self
+            return
+        muons = self.sample_x()
+        self._crn_seed = int(np.random.randint(2**31)) if seed is None else seed
+        self._crn_key = self._muons_key(muons)
+        self._crn_muons = muons
+        try: yield self
+        finally: self._crn_muons = self._crn_key = self._crn_seed = None
+
+    @property
+    def pool(self):
+        '''Persistent worker pool used by simulate, created on first use.'''
+        if self._pool is None:
+            self._pool = EvaluationPool(self.cores)
+        return self._pool
+    @property
+    def chunk_executor(self):
+        '''Runs the muon chunks of an evaluation, duplicating stragglers (see ChunkExecutor).
+        The pool is restarted when a chunk times out, so a hung simulation does not keep a worker.'''
+        if self._chunk_executor is None:
+            self._chunk_executor = ChunkExecutor(self.pool.submit, self.straggler_factor, recover = self.pool.recover,
+                                                 timeout = self.chunk_timeout, retries = self.chunk_retries,
+                                                 reseed = partial(_reseed_workload, self.seed), restart = self.pool.restart)
+        return self._chunk_executor
+    def start(self):
+        '''Fork the simulation workers ahead of the first evaluation.'''
+        self.pool.start()
+        return self
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+        self.electrical_costs.flush()
+        if self._shared_muons is not None:
+            self._shared_muons.close()
+            self._shared_muons = None
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, *exc):
+        self.close()
+
+    def _sample_identity(self, idx = None):
+        '''What determines the sample of sample_x, or None if it is a random subset (unseeded).'''
+        if self.muons_file.endswith('.npy') or self.muons_file.endswith(MuonStore.suffix):
+            if 0 < self.n_samples and self.subset_seed is None: return None
+        st = os.stat(self.muons_file)  # a rewritten file is a new sample
+        return (self.muons_file, st.st_mtime_ns, st.st_size, self.n_samples, idx, self.subset_seed, self.sampling, self.strata, self._strata_version)
+
+    def _muons_key(self, muons):
+        '''Key of a muon sample. The CRN sample and the cached sample of sample_x are keyed by
+        their identity, samples of unknown origin by their fingerprint (see array_fingerprint).'''
+        if self._crn_key is not None and muons is self._crn_muons: return self._crn_key
+        if self._sample is not None and muons is self._sample[1]: return hash_key('sample', self._sample[0])
+        return array_fingerprint(muons)
 
     def sample_x(self,phi=None, idx = None):
+        if self._crn_muons is not None:
+            self._sum_weights = self._crn_muons[:, -1].sum()
+            return self._crn_muons
+        if self.sampling == 'stratified' and self.strata_pilot and self._strata_version == 0 and self.muons_file.endswith(('.npy', MuonStore.suffix)):
+            self.pilot_strata(idx = idx)
+        # the full file and seeded subsets are the same sample every time: reuse it (and its shared buffer)
+        sample_id = self._sample_identity(idx)
+        if sample_id is not None and self._sample is not None and self._sample[0] == sample_id:
+            self._sum_weights = self._sample[1][:, -1].sum()
+            return self._sample[1]
         print('Sampling muons')
         t1 = time.time()
         if idx is None: idx = slice(None)
         else: idx = slice(*idx)
-        if self.muons_file.endswith('.npy'):
-            mmap_array = np.load(self.muons_file, mmap_mode='r')
-            x = mmap_array[idx].copy()
-            if 0<self.n_samples<x.shape[0]: 
-                indices = np.random.choice(x.shape[0], self.n_samples, replace=False)
-                x = x[indices]
+        if self.muons_file.endswith(('.npy', MuonStore.suffix)):
+            if self.sampling == 'stratified':
+                x = self._sampler().sample_stratified(self.n_samples, idx, seed = self.subset_seed, bins = self.strata)
+            else: x = self._sampler().sample(self.n_samples, idx, seed = self.subset_seed)
         elif self.muons_file.endswith('.h5'):
             if self.n_samples == 0:
                 with h5py.File(self.muons_file, "r") as f:
@@ -942,10 +1195,37 @@ class ShipMuonShield():
         print(f'Sampling muons took {time.time()-t1:.2f} seconds')    
         x = torch.from_numpy(x)                  
         self._sum_weights = x[:, -1].sum()    
+        self._sample = (sample_id, x) if sample_id is not None else None
         return x
+    def _sampler(self):
+        if self._muon_sampler is None or self._muon_sampler.file != self.muons_file:
+            self._muon_sampler = MuonSampler(self.muons_file)
+        return self._muon_sampler
+    def pilot_strata(self, phi = None, n_per_stratum:int = None, idx = None):
+        '''Set the stratified allocation (see MuonStrata) from the hit rate of every stratum,
+        simulated for phi (the default geometry if None) on a pilot sample of n_per_stratum
+        (strata_pilot by default) muons per stratum. Called by sample_x before the first
+        stratified sample if strata_pilot is set. Returns the updated MuonStrata.'''
+        if phi is None: phi = self.DEFAULT_PHI
+        if n_per_stratum is None: n_per_stratum = self.strata_pilot
+        sampler = self._sampler()
+        strata = sampler.get_strata(slice(*idx) if idx is not None else slice(None), self.strata)
+        indices, bounds = strata.pilot(n_per_stratum, np.random.default_rng(self.subset_seed))
+        muons = torch.from_numpy(gather_rows(sampler.array, strata.range[0] + indices))
+        n = np.diff(bounds)
+        chunks = [(start, stop) for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()) if stop > start]
+        hits = np.zeros(strata.n_strata)
+        hits[n > 0] = self.simulate_batch(phi, muons, reduce = True, chunks = chunks)[0][:, 2].cpu().numpy()
+        strata.update_from_hits(hits, n)
+        self._strata_version += 1
+        self._sample = None  # drawn with the previous allocation
+        print(f'Stratified allocation set from a pilot of {len(muons)} muons')
+        return strata
     def get_weights(self, x):
         return x[:, -1]
-    def simulate_mag_fields(self,phi:torch.tensor, cores:int = 7):
+    def simulate_mag_fields(self,phi:torch.tensor, cores:int = 7, file_name:str = None):
+        '''Generate the field map of phi and return its path. With a field map store and no
+        explicit file_name, maps are keyed by geometry and d_space and reused when already computed.'''
         phi = self.add_fixed_params(phi)
         z_gap, dZ, dXIn, dXOut, dYIn, dYOut, gapIn, gapOut, ratio_yokesIn, ratio_yokesOut, \
         dY_yokeIn, dY_yokeOut, XmgapIn, XmgapOut = phi[:, :14].T
@@ -960,20 +1240,50 @@ class ShipMuonShield():
         max_x = int((max_x // self.resol[0]) * self.resol[0])
         max_y = int((max_y // self.resol[1]) * self.resol[1])
         d_space = ((0,max_x+30), (0,max_y+30), (-50, int(((length+200) // self.resol[2]) * self.resol[2])))
-        self.run_magnet(True,phi.cpu().numpy(),file_name = self.fields_file,d_space = d_space, cores = cores, fSC_mag = self.fSC_mag, use_diluted = self.use_diluted,NI_from_B_goal = self.use_B_goal)
-
-    def simulate(self,phi:torch.tensor,muons = None, return_all = False, simulate_fields = True): 
-        phi = self.add_fixed_params(phi)
-        if muons is None: muons = self.sample_x()
-        self._sum_weights = muons[:, -1].sum()
-        workloads = split_array(muons,self.cores)
-        assert phi.shape[1] == 15, f"Expected phi to have 15 columns, got {phi.shape}"
-        if simulate_fields and (not self.uniform_fields): 
-            print('SIMULATING MAGNETIC FIELDS')
-            self.simulate_mag_fields(phi)
-        run_partial = partial(self.run_muonshield, 
-                      params=phi.cpu().numpy(), 
-                      return_cost=False, 
+        def compute(file_name):
+            self.run_magnet(True,phi.detach().cpu().numpy(),file_name = file_name,d_space = d_space, cores = cores, fSC_mag = self.fSC_mag, use_diluted = self.use_diluted,NI_from_B_goal = self.use_B_goal)
+        if file_name is None and self.field_maps is not None:
+            key = hash_key(phi, d_space, self.resol, self.fSC_mag, self.use_diluted, self.use_B_goal)
+            if self.field_slabs is not None: compute = partial(self._stitch_magnet_slabs, phi, d_space, cores)
+            return self.field_maps.get_or_compute(key, compute)
+        if file_name is None: file_name = self.fields_file
+        compute(file_name)
+        return file_name
+
+    def _magnet_slabs(self, phi, z_range):
+        '''z-range of the field slab of each magnet: slabs are cut in the middle of the
+        gaps between consecutive magnets, snapped to the field resolution.'''
+        r = self.resol[2]
+        Z_out = torch.cumsum(phi[:,0] + 2*phi[:,1], dim=0)
+        Z_in = Z_out - 2*phi[:,1]
+        cuts = [int((((Z_out[i-1] + Z_in[i]) / 2).item() // r) * r) for i in range(1, len(phi))]
+        edges = [z_range[0]] + cuts + [z_range[1]]
+        ranges = [(edges[i], edges[i+1] - r) for i in range(len(phi)-1)] + [(edges[-2], edges[-1])]
+        return ranges, Z_in
+
+    def _stitch_magnet_slabs(self, phi, d_space, cores, file_name):
+        '''Assemble the field map from per-magnet z-slabs. Each slab is keyed by the parameters
+        of its magnet and its z position, so only the slabs of changed magnets are recomputed.'''
+        ranges, Z_in = self._magnet_slabs(phi, d_space[2])
+        params = phi.detach().cpu().numpy()
+        n_computed = 0
+        def compute_slab(z_range, slab_file):
+            nonlocal n_computed
+            n_computed += 1
+            self.run_magnet(True, params, file_name = slab_file, d_space = (d_space[0], d_space[1], z_range), cores = cores,
+                            fSC_mag = self.fSC_mag, use_diluted = self.use_diluted, NI_from_B_goal = self.use_B_goal)
+        with self.field_slabs.hold():
+            slabs = []
+            for i, z_range in enumerate(ranges):
+                key = hash_key(phi[i], Z_in[i], z_range, d_space[:2], self.resol,
+                               self.fSC_mag and i == 1, self.use_diluted, self.use_B_goal)
+                slabs.append(self.field_slabs.get_or_compute(key, partial(compute_slab, z_range)))
+            stitch_field_maps(slabs, file_name)
+        print(f'Recomputed {n_computed} of {len(ranges)} field slabs')
+
+    def _run_kwargs(self, return_all = False):
+        '''Keyword arguments of run_muonshield shared by all the workloads of an evaluation.'''
+        return dict(return_cost=False, 
                       fSC_mag=self.fSC_mag, 
                       sensitive_film_params=self.sensitive_plane, 
                       add_cavern=self.cavern, 
@@ -987,47 +1297,134 @@ class ShipMuonShield():
                       keep_tracks_of_hits=False, 
                       extra_magnet=self.extra_magnet,
                       NI_from_B = self.use_B_goal,
-                     add_decay_vessel = self.decay_vessel_sensitive,
+                      add_decay_vessel = self.decay_vessel_sensitive,
                       use_diluted = self.use_diluted,
                       SND = self.SND)
-        with Pool(self.cores) as pool:
-            result = pool.map(run_partial, workloads)
+
+    def _is_single(self, phi):
+        '''True if phi is one candidate: a vector, or a full (n_magnets, n_params) geometry.
+        Decided from the shape, never from the element count (a batch of reduced
+        parametrizations can have n_magnets*n_params elements too).'''
+        if phi.dim() == 1: return True
+        return phi.dim() == 2 and tuple(phi.shape) == (self.n_magnets, self.n_params) and self.dim != self.n_params
+    def _as_batch(self, phi):
+        '''View phi as (N, d): a single candidate (see _is_single) becomes one row.'''
+        if phi.dim() == 3: return phi.reshape(phi.size(0), -1)
+        if self._is_single(phi): return phi.reshape(1, -1)
+        return phi
+
+    def _share_muons(self, muons):
+        '''Shared-memory copy of the muon sample, kept (and reused) until the sample changes.'''
+        source = (muons.data_ptr(), tuple(muons.shape), muons.dtype) if torch.is_tensor(muons) else (id(muons), muons.shape)
+        if self._shared_muons is None or self._shared_source[0] != source:
+            if self._shared_muons is not None: self._shared_muons.close()
+            array = muons.detach().cpu().numpy() if torch.is_tensor(muons) else np.asarray(muons)
+            self._shared_muons = SharedMuonBuffer(array)
+            self._shared_key = self._muons_key(muons) if self.cache is not None else None
+            # keep a reference so the memory of the sample cannot be reused by a new one
+            self._shared_source = (source, muons)
+        return self._shared_muons
+
+    def _candidate_fields_file(self, i:int, n_candidates:int):
+        if n_candidates == 1: return self.fields_file
+        root, ext = os.path.splitext(self.fields_file)
+        return f'{root}_{i}{ext}'
+
+    def simulate_batch(self, phi:torch.tensor, muons = None, return_all = False, simulate_fields = True, fields_files = None, reduce = False, chunks = None):
+        '''Simulate several candidates on the same muons with a single pool dispatch.
+
+        The workload list is built over (candidate, muon chunk) pairs so that all
+        the cores are kept busy across candidates; the outputs are then regrouped
+        per candidate. chunks, a sorted list of (start, stop) muon ranges, replaces the
+        per-core split (e.g. one range per stratum, see pilot_strata); such runs are not cached. Returns a list with the (8, n_out) outputs of each candidate or,
+        with reduce, the (n_chunks, 4) loss partials computed by the workers (see MuonLossKernel).'''
+        phi = self._as_batch(phi)
+        phis = list(self.add_fixed_params_batch(phi))
+        assert all(p.shape[1] == 15 for p in phis), f"Expected phi to have 15 columns, got {phis[0].shape}"
+        if muons is None: muons = self.sample_x()
+        self._sum_weights = muons[:, -1].sum()
+        if fields_files is not None: simulate_fields = False # maps already computed for these candidates
+        else: fields_files = [self._candidate_fields_file(i, len(phis)) for i in range(len(phis))]
+        with (self.field_maps.hold() if self.field_maps is not None else nullcontext()):
+            if simulate_fields and (not self.uniform_fields): 
+                print('SIMULATING MAGNETIC FIELDS')
+                fields_files = [self.simulate_mag_fields(p, file_name = None if self.field_maps is not None else file_name)
+                                for p, file_name in zip(phis, fields_files)]
+            params = [p.detach().cpu().numpy() for p in phis]
+            shared = self._share_muons(muons)
+            # results per candidate and muon range; with reduce and a cache, the partials of finished
+            # chunks are persisted (at most every chunk_save_interval seconds, and when the run fails),
+            # so a retried or resumed evaluation only simulates the missing ranges
+            stored = [{} for _ in params]
+            chunk_keys = None
+            if reduce and self.cache is not None and chunks is None:
+                chunk_keys = [hash_key('chunks', self._shared_key, self.evaluation_key(p)) for p in phi]
+                stored = [self.cache.get(key, {}) if key in self.cache else {} for key in chunk_keys]
+            self._partial_keys = [[key] for key in chunk_keys] if chunk_keys is not None else [[] for _ in params]
+            slots = None
+            if chunks is not None:
+                workloads = [(shared.descriptor(*idx), params[i], fields_files[i]) for i in range(len(params)) for idx in chunks]
+            elif self._crn_seed is None and self.chunker is not None:
+                # work stealing: ranges are cut on demand, sized from the measured throughput
+                spans = [missing_ranges(stored[i], 0, len(shared)) for i in range(len(params))]
+                workloads = ((shared.descriptor(*idx), params[i], fields_files[i]) for i, idx in self.chunker.ranges(spans))
+                slots = self.cores
+            elif self._crn_seed is None:
+                workloads = [(shared.descriptor(*gap), params[i], fields_files[i])
+                             for i, idx in split_indices_parallel(len(params), len(shared), max(self.cores, len(params)))
+                             for gap in missing_ranges(stored[i], *idx)]
+            else: # same chunks and per-chunk seeds for every candidate, whatever the batch size
+                chunks = get_split_indices(min(self.cores, len(shared)), len(shared))
+                workloads = [(shared.descriptor(*gap), params[i], fields_files[i], self._crn_seed + j)
+                             for i in range(len(params)) for j, idx in enumerate(chunks)
+                             for gap in missing_ranges(stored[i], *idx)]
+            owner_of = {id(p): i for i, p in enumerate(params)} # retries keep the same params array
+            saved, unsaved = [time.time()] * len(params), set()
+            def save(i):
+                self.cache.put(chunk_keys[i], stored[i])
+                saved[i] = time.time()
+                unsaved.discard(i)
+            def on_done(workload, result, seconds):
+                i, idx = owner_of[id(workload[1])], workload[0][3:5]
+                if slots is not None: self.chunker.record(idx[1] - idx[0], seconds)
+                stored[i][idx] = result
+                if chunk_keys is None: return
+                unsaved.add(i)
+                if time.time() - saved[i] >= self.chunk_save_interval: save(i)
+            if reduce: run_partial = partial(_run_workload_reduced, self.run_muonshield, self.loss_kernel, **self._run_kwargs(return_all))
+            else: run_partial = partial(_run_workload, self.run_muonshield, **self._run_kwargs(return_all))
+            try: self.chunk_executor.run(run_partial, workloads, slots, on_done)
+            except BaseException:
+                for i in list(unsaved): save(i)
+                raise
+        self._last_fields_files = fields_files
         print('SIMULATION FINISHED')
-        all_results = []
-        for rr in result:
-            resulting_data = rr
-            if resulting_data.size == 0: continue
-            all_results += [resulting_data]
-        if len(all_results) == 0:
-            return torch.tensor([[],[],[],[],[],[],[],[]], device=phi.device)
-        all_results = np.concatenate(all_results, axis=0).T
-        if all_results.dtype != object: # Only convert to tensor if all_results is a numeric array (not array of dicts)
-            all_results = torch.as_tensor(all_results, device=phi.device, dtype=torch.get_default_dtype())
-        return all_results
+        if reduce:
+            return [torch.stack([stored[i][idx] for idx in sorted(stored[i])]) for i in range(len(phis))]
+        outputs = []
+        for i in range(len(phis)):
+            all_results = [stored[i][idx] for idx in sorted(stored[i]) if stored[i][idx].size > 0]
+            if len(all_results) == 0:
+                outputs.append(torch.tensor([[],[],[],[],[],[],[],[]], device=phi.device))
+                continue
+            all_results = np.concatenate(all_results, axis=0).T
+            if all_results.dtype != object: # Only convert to tensor if all_results is a numeric array (not array of dicts)
+                all_results = torch.as_tensor(all_results, device=phi.device, dtype=torch.get_default_dtype())
+            outputs.append(all_results)
+        return outputs
+
+    def simulate(self,phi:torch.tensor,muons = None, return_all = False, simulate_fields = True): 
+        return self.simulate_batch(phi, muons, return_all = return_all, simulate_fields = simulate_fields)[0]
+    @property
+    def loss_kernel(self):
+        '''Picklable loss of the current settings, shared by the parent and the pool workers.'''
+        return MuonLossKernel(self.x_margin, self.y_margin, self.sensitive_plane[-1], self.cut_P, self.loss_fn, self.reduction)
     def is_hit(self, px, py, pz, x, y, z, particle, factor=None):
-        mask = (torch.abs(x) <= self.x_margin) & (torch.abs(y) <= self.y_margin) 
-        mask = mask & (torch.abs(z - self.sensitive_plane[-1]['position']) <= self.sensitive_plane[-1]['dz'])
-        mask = mask & (torch.abs(particle).to(torch.int)==self.MUON)
-        if self.cut_P is not None: 
-            p = torch.sqrt(px**2+py**2+pz**2)
-            mask = mask & p.ge(self.cut_P)
-        return mask.to(torch.bool)
+        return self.loss_kernel.is_hit(px, py, pz, x, y, z, particle)
     def _continuous_loss(self, px, py, pz, x, y, z, particle, weight=None):
-        if x.numel() == 0 or x.isnan().all():
-            return torch.tensor(0.0, device=x.device)
-        charge = -1 * torch.sign(particle)
-        mask = self.is_hit(px, py, pz, x, y, z, particle).to(torch.bool)
-        loss = torch.zeros_like(x)
-        loss[mask] = torch.sqrt(1 + (charge[mask] * x[mask] - self.x_margin) / (2 * self.x_margin))
-        return loss
+        return self.loss_kernel.continuous_loss(px, py, pz, x, y, z, particle, weight)
     def _blackbox_loss(self, px, py, pz, x, y, z, particle, weight=None):
-        if self.loss_fn == 'continuous':
-            loss =  self._continuous_loss(px,py,pz,x,y,z,particle, weight)
-        elif self.loss_fn == 'hits':
-            loss = self.is_hit(px, py, pz, x, y, z, particle).to(torch.float)
-        if (self.reduction != 'none') and (weight is not None):
-            loss = weight * loss
-        return loss
+        return self.loss_kernel(px, py, pz, x, y, z, particle, weight)
 
     def get_total_length(self, phi):
         phi = self.add_fixed_params(phi)
@@ -1035,84 +1432,56 @@ class ShipMuonShield():
         return length / 100
 
     def get_electrical_cost(self,phi):
-        '''Adapt for multidimensional phi'''
-        phi = self.add_fixed_params(phi).detach().cpu().numpy()
-        cost = 0
-        for idx,params in enumerate(phi):
-            Ymgap = 0
-            if self.fSC_mag and idx == 1: 
-                yoke_type = 'Mag2'
-                Ymgap = self.SC_Ymgap
-            elif self.use_diluted: yoke_type = 'Mag1'
-            else: yoke_type = 'Mag3' if params[14]<0 else 'Mag1'
-            cost+= self.estimate_electrical_cost(params,yoke_type,Ymgap,materials_directory = self.materials_directory, NI_from_B = self.use_B_goal)
-        return cost
-
-    def get_iron_cost(self, phi):
-        #TODO use directly create_magnet from muons_and_matter
-        '''Adapt for multidiomensional phi
-        make electrical cost esimation with torch'''
-        material =  'aisi1010.json'
-        with open(os.path.join(self.materials_directory,material)) as f:
-            iron_material_data = json.load(f)
-        density = iron_material_data['density(g/m3)']*1E-9
-        phi = self.add_fixed_params(phi)
-        volume = 0
-        for idx,params in enumerate(phi):
-            Ymgap = 0
-            if self.fSC_mag and idx == 1: 
-                Ymgap = self.SC_Ymgap
-            dZ = params[1]
-            dX = params[2]
-            dX2 = params[3]
-            dY = params[4]
-            dY2 = params[5]
-            gap = params[6]
-            gap2 = params[7]
-            ratio_yoke_1 = params[8]
-            ratio_yoke_2 = params[9]
-            dY_yoke_1 = params[10]
-            dY_yoke_2 = params[11]
-            X_mgap_1 = params[12]
-            X_mgap_2 = params[13]
-            corners = torch.tensor([
-            [X_mgap_1+dX, 0, 0],
-            [X_mgap_1 + dX, dY, 0],
-            [0, dY, 0],
-            [0, 0, 0],
-            [X_mgap_2+dX2,0, 2*dZ],
-            [X_mgap_2+dX2, dY2, 2*dZ],
-            [0, dY2, 2*dZ],
-            [0, 0, 2*dZ]
-            ])
-            volume += compute_solid_volume(corners)
-            corners = torch.tensor([
-            [X_mgap_1 + dX + gap, 0, 0],
-            [X_mgap_1 + dX + gap + dX * ratio_yoke_1, 0, 0],
-            [X_mgap_1 + dX + gap + dX * ratio_yoke_1, dY + Ymgap, 0],
-            [X_mgap_1 + dX + gap, dY + Ymgap, 0],
-            [X_mgap_2 + dX2 + gap2, 0, 2 * dZ],
-            [X_mgap_2 + dX2 + gap2 + dX2 * ratio_yoke_2, 0, 2 * dZ],
-            [X_mgap_2 + dX2 + gap2 + dX2 * ratio_yoke_2, dY2 + Ymgap, 2 * dZ],
-            [X_mgap_2 + dX2 + gap2, dY2 + Ymgap, 2 * dZ],
-            ])
-            volume += compute_solid_volume(corners)
-
-            corners = torch.tensor([
-            [X_mgap_1, dY, 0],
-            [X_mgap_1 + dX + gap + dX * ratio_yoke_1, dY, 0],
-            [X_mgap_1 + dX + gap + dX * ratio_yoke_1, dY + dY_yoke_1, 0],
-            [X_mgap_1, dY + dY_yoke_1, 0],
-            [X_mgap_2, dY2, 2 * dZ],
-            [X_mgap_2 + dX2 + gap2 + dX2 * ratio_yoke_2, dY2, 2 * dZ],
-            [X_mgap_2 + dX2 + gap2 + dX2 * ratio_yoke_2, dY2 + dY_yoke_2, 2 * dZ],
-            [X_mgap_2, dY2 + dY_yoke_2, 2 * dZ],
-            ])
-            volume += compute_solid_volume(corners)
-        M_iron = 4*volume*density    
-        C_iron = M_iron*(iron_material_data["material_cost(CHF/kg)"]
-                     +  iron_material_data["manufacturing_cost(CHF/kg)"])
-        return C_iron.detach()
+        '''Electrical cost of one candidate, or of each candidate of a (N, dim) batch.'''
+        single = self._is_single(phi)
+        device = phi.device
+        phis = self.add_fixed_params_batch(self._as_batch(phi)).detach().cpu().numpy()
+        costs = []
+        for phi in phis:
+            cost = 0
+            for idx,params in enumerate(phi):
+                Ymgap = 0
+                if self.fSC_mag and idx == 1: 
+                    yoke_type = 'Mag2'
+                    Ymgap = self.SC_Ymgap
+                elif self.use_diluted: yoke_type = 'Mag1'
+                else: yoke_type = 'Mag3' if params[14]<0 else 'Mag1'
+                cost+= self._magnet_electrical_cost(params, yoke_type, Ymgap)
+            costs.append(cost)
+        return costs[0] if single else torch.as_tensor(costs, device=device, dtype=torch.get_default_dtype())
+
+    def _magnet_electrical_cost(self, params, yoke_type, Ymgap):
+        '''Electrical cost of a single magnet, memoised on its parameter row and yoke settings.'''
+        key = hash_key(params, yoke_type, Ymgap, self.use_B_goal)
+        return self.electrical_costs.get_or_compute(key, lambda: self.estimate_electrical_cost(
+            params, yoke_type, Ymgap, materials_directory = self.materials_directory, NI_from_B = self.use_B_goal))
+
+    @property
+    def iron_material(self):
+        if getattr(self, '_iron_material', None) is None:
+            with open(os.path.join(self.materials_directory, 'aisi1010.json')) as f:
+                self._iron_material = json.load(f)
+        return self._iron_material
+
+    def get_iron_cost(self, phi, detach:bool = True):
+        '''Iron cost of one candidate (scalar) or of a batch of shape (N, dim) (tensor of N costs).
+        The three solids of each magnet (core, return yoke, top yoke) are prismatoids
+        between the entrance and exit rectangles, so their volumes are computed in closed form.'''
+        single = self._is_single(phi)
+        phi = self.add_fixed_params_batch(self._as_batch(phi))
+        dZ, dX, dX2, dY, dY2, gap, gap2, ratio_yoke_1, ratio_yoke_2, dY_yoke_1, dY_yoke_2, X_mgap_1, X_mgap_2 = phi[..., 1:14].unbind(-1)
+        Ymgap = torch.zeros(self.n_magnets, device=phi.device, dtype=phi.dtype)
+        if self.fSC_mag: Ymgap[1] = self.SC_Ymgap
+        volume = compute_prismatoid_volume(X_mgap_1 + dX, dY, X_mgap_2 + dX2, dY2, 2*dZ)
+        volume = volume + compute_prismatoid_volume(dX * ratio_yoke_1, dY + Ymgap, dX2 * ratio_yoke_2, dY2 + Ymgap, 2*dZ)
+        volume = volume + compute_prismatoid_volume(dX + gap + dX * ratio_yoke_1, dY_yoke_1,
+                                                    dX2 + gap2 + dX2 * ratio_yoke_2, dY_yoke_2, 2*dZ)
+        density = self.iron_material['density(g/m3)']*1E-9
+        M_iron = 4*volume.sum(-1)*density
+        C_iron = M_iron*(self.iron_material["material_cost(CHF/kg)"]
+                     +  self.iron_material["manufacturing_cost(CHF/kg)"])
+        if detach: C_iron = C_iron.detach()
+        return C_iron[0] if single else C_iron
     def get_total_cost(self,phi):
         try:
             M = self.get_iron_cost(phi) + self.get_electrical_cost(phi)
@@ -1132,28 +1501,160 @@ class ShipMuonShield():
         elif self.cost_loss_fn == 'linear_length':
             return W/(1-L/self.L0)
         else: return 1
+    def evaluation_key(self, phi, muons = None, idx = None):
+        '''Hash identifying an evaluation: full geometry, muon subset, seed and every loss-relevant setting.'''
+        if muons is None and self._crn_key is not None: muons_id = self._crn_key
+        else: muons_id = self._muons_key(muons) if muons is not None else (self.muons_file, self.n_samples, idx, self.subset_seed, self.sampling, self.strata, self._strata_version)
+        config = dict(sensitive_plane = self.sensitive_plane, loss_fn = self.loss_fn, cut_P = self.cut_P,
+                      x_margin = self.x_margin, y_margin = self.y_margin, reduction = self.reduction,
+                      fSC_mag = self.fSC_mag, uniform_fields = self.uniform_fields, cavern = self.cavern,
+                      SmearBeamRadius = self.SmearBeamRadius, add_target = self.add_target,
+                      extra_magnet = self.extra_magnet, use_B_goal = self.use_B_goal, SND = self.SND,
+                      decay_vessel_sensitive = self.decay_vessel_sensitive, use_diluted = self.use_diluted,
+                      apply_det_loss = self.apply_det_loss, cost_loss_fn = self.cost_loss_fn,
+                      cost_as_constraint = self.cost_as_constraint, W0 = self.W0, L0 = self.L0)
+        seed = self.seed if self._crn_seed is None else ('crn', self._crn_seed)
+        return hash_key(type(self).__name__, self.add_fixed_params(phi), muons_id, seed, config)
+    def feasibility_gate(self, phi):
+        '''Batched pre-simulation gate: boolean mask (N,) of the candidates worth simulating.
+        A candidate is rejected if its constraint penalty exceeds 10 or (without cost_as_constraint)
+        its cost is beyond the exponential cut. Counts are kept in gate_stats.'''
+        phi = self._as_batch(phi)
+        with torch.no_grad():
+            jump = self.get_constraints(phi) > 10
+            if not self.cost_as_constraint:
+                M = torch.as_tensor(self.get_total_cost(phi), device=jump.device)
+                jump = jump | (M > ((6 * np.log(10) / 10 + 1) * self.W0))
+        self.gate_stats['candidates'] += len(jump)
+        self.gate_stats['saved_simulations'] += int(jump.sum())
+        return ~jump
+    def is_infeasible(self, phi):
+        '''True if phi violates the constraints (or the cost cut) so badly that it is not worth simulating.'''
+        return not bool(self.feasibility_gate(phi)[0])
+    def _reduce_loss(self, loss):
+        if self.reduction == 'mean':
+            return loss.sum()*1e6 / self._sum_weights
+        elif self.reduction == 'sum':
+            return loss.sum()
+        return loss
+    def _call_batch(self, phi, muons = None):
+        '''Evaluate N candidates on the same muons with a single simulation dispatch.
+        Infeasible candidates are not simulated and get 1E6. Returns a (N,1) tensor;
+        last_censored (N,) flags the rows that are early-stopped estimates.'''
+        phi = self._as_batch(phi)
+        y = torch.full((phi.size(0), 1), 1E6, device=phi.device)
+        self.last_censored = torch.zeros(phi.size(0), dtype=torch.bool)
+        keys = [self.evaluation_key(p, muons) if self.cache is not None else None for p in phi]
+        pending = []
+        for i, p in enumerate(phi):
+            cached = self.cache.get(keys[i]) if keys[i] is not None else None
+            if cached is not None: y[i] = cached
+            else: pending.append(i)
+        if len(pending) == 0:
+            return y
+        feasible = [i for i, ok in zip(pending, self.feasibility_gate(phi[pending]).tolist()) if ok]
+        print(f'Feasibility gate: simulating {len(feasible)} of {len(pending)} candidates')
+        if len(feasible) == 0:
+            return y
+        losses, censored = self._simulate_losses(phi[feasible], muons)
+        for i, loss, cens, partial_keys in zip(feasible, losses, censored, self._partial_keys):
+            y[i] = loss
+            self.last_censored[i] = cens
+            if keys[i] is not None and not cens: self._cache_loss(keys[i], y[i], partial_keys)
+        return y
+    def _cache_loss(self, key, loss, partial_keys = ()):
+        '''Cache a full evaluation; the chunk partials it was assembled from are no longer needed.'''
+        self.cache.put(key, loss.cpu())
+        for partial_key in partial_keys: self.cache.remove(partial_key)
+    def _simulate_losses(self, phi, muons = None):
+        '''Reduced losses (N,) of a batch of candidates, and whether each evaluation was censored
+        (stopped early, see _simulate_waves).'''
+        self._partial_keys = [[] for _ in range(self._as_batch(phi).size(0))]  # set by simulate_batch when it persists chunk partials
+        try:
+            if self.early_stopping and self.stop_threshold is not None:
+                return self._simulate_waves(phi, muons)
+            partials = self.simulate_batch(phi, muons, reduce = True)
+        except Exception as e:
+            print(f"Error occurred with inputs: {phi}")
+            print(e)
+            raise
+        losses = torch.stack([self._reduce_loss(p[:, 0]) for p in partials]).to(phi.device)
+        return losses, [False] * len(partials)
+    def _ratio_bound(self, L, W, W_total):
+        '''Ratio estimate of the reduced loss from per-wave loss sums L and weight sums W,
+        and its lower confidence bound (early_stop_z standard errors, finite population corrected).'''
+        k = len(W)
+        R = L.sum() / W.sum()
+        scale = 1e6 if self.reduction == 'mean' else W_total
+        if k < 2: return R * scale, -float('inf')
+        s2 = (L - R * W).pow(2).sum() / (k - 1)
+        var = (1 - W.sum() / W_total).clamp(min=0) * k * s2 / W.sum().pow(2)
+        return R * scale, (R - self.early_stop_z * var.sqrt()) * scale
+    def _simulate_waves(self, phi, muons = None):
+        '''Simulate a batch of candidates on the (shuffled) muons in early_stop_waves waves.
+        After each wave, candidates whose lower confidence bound already exceeds stop_threshold
+        are not simulated further; their loss is the ratio estimate from the waves seen (censored).'''
+        phi = self._as_batch(phi)
+        if muons is None: muons = self.sample_x()
+        generator = torch.Generator().manual_seed(self._crn_seed) if self._crn_seed is not None else None
+        muons = muons[torch.randperm(muons.size(0), generator=generator).to(muons.device)]
+        W_total = muons[:, -1].sum()
+        waves = torch.tensor_split(muons, self.early_stop_waves)
+        n_waves, N = len(waves), phi.size(0)
+        L = torch.zeros(N, n_waves)
+        W = torch.stack([wave[:, -1].sum() for wave in waves]).cpu()
+        n_done = [0] * N
+        active = list(range(N))
+        fields_files = None
+        partial_keys = [[] for _ in range(N)]
+        with (self.field_maps.hold() if self.field_maps is not None else nullcontext()): # the maps of the first wave are reused
+            for w, wave in enumerate(waves):
+                self._partial_keys = []
+                partials = self.simulate_batch(phi[active], wave, reduce = True,
+                                               fields_files = None if fields_files is None else [fields_files[i] for i in active])
+                if fields_files is None: fields_files = self._last_fields_files
+                for i, keys in zip(active, self._partial_keys): partial_keys[i] += keys
+                for i, p in zip(active, partials):
+                    L[i, w] = p[:, 0].sum()
+                    n_done[i] = w + 1
+                if w + 1 == n_waves: break
+                active = [i for i in active if self._ratio_bound(L[i,:w+1], W[:w+1], W_total.cpu())[1] <= self.stop_threshold]
+                if len(active) == 0: break
+        losses = torch.stack([self._ratio_bound(L[i,:n_done[i]], W[:n_done[i]], W_total.cpu())[0] for i in range(N)])
+        censored = [n < n_waves for n in n_done]
+        self._partial_keys = partial_keys
+        self.early_stop_stats['evaluations'] += N
+        self.early_stop_stats['censored'] += sum(censored)
+        self.early_stop_stats['waves_saved'] += sum(n_waves - n for n in n_done)
+        if any(censored): print(f'Early stopping: {sum(censored)} of {N} candidates censored')
+        return losses.to(phi.device), censored
     def __call__(self,phi,muons = None):
-        if phi.dim()>1:
+        if not self._is_single(phi) and self.reduction != 'none':
+            return self._call_batch(phi, muons)
+        elif not self._is_single(phi):
             y = []
             for p in phi:
                 y.append(self(p))
+            self.last_censored = torch.zeros(len(y), dtype=torch.bool)
             return torch.stack(y)
-        M = self.get_total_cost(phi)
-        jump = self.get_constraints(phi) > 10
-        if not self.cost_as_constraint: jump = jump | (M > ((6 * np.log(10) / 10 + 1) * self.W0))
-        jump = jump & (self.reduction != 'none')
-        if jump: 
+        self.last_censored = torch.zeros(1, dtype=torch.bool)
+        key = self.evaluation_key(phi, muons) if (self.cache is not None and self.reduction != 'none') else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None: return cached.to(phi.device)
+        if self.reduction != 'none' and self.is_infeasible(phi): 
             return torch.ones((1,1),device=phi.device)*1E6
+        if self.reduction != 'none':
+            loss, censored = self._simulate_losses(phi, muons)
+            self.last_censored = torch.tensor(censored[:1], dtype=torch.bool)
+            if key is not None and not censored[0]: self._cache_loss(key, loss[0], self._partial_keys[0])
+            return loss[0]
         try: loss = self.simulate(phi, muons, return_all=(self.reduction=='none'))
         except Exception as e:
             print(f"Error occurred with input: {self.add_fixed_params(phi)}")
             print(e)
             raise
         loss = self._blackbox_loss(*loss)
-        if self.reduction == 'mean':
-            return loss.sum()*1e6 / self._sum_weights
-        elif self.reduction == 'sum':
-            return loss.sum()
         if self.apply_det_loss:
             loss = loss + self._apply_deterministic_loss(phi, loss)
         return loss
@@ -1262,80 +1763,69 @@ class ShipMuonShield():
         return bounds
 
     def add_fixed_params(self, phi: torch.Tensor):
-        if phi.numel() != (self.n_magnets * self.n_params):
-            new_phi = self.DEFAULT_PHI.clone().to(phi.device)
-            new_phi = new_phi.index_put(
-                (self.params_idx[:,0], self.params_idx[:,1]),
-                phi
-            )
-            rows = torch.arange(1, new_phi.size(0), device=new_phi.device)
-
-            # new_phi[:,13] = new_phi[:,12] MIDDLE-GAP IDENTICAL ENTER-EXIT
-            new_phi = new_phi.index_put(
-                (rows, torch.tensor([13])),
-                new_phi[rows, 12]
-            )
-            
-            if self.use_diluted:
-                
+        if phi.numel() == (self.n_magnets * self.n_params):
+            return phi.view(self.n_magnets, self.n_params)
+        return self.add_fixed_params_batch(phi.reshape(1, -1))[0]
+
+    def add_fixed_params_batch(self, phi: torch.Tensor):
+        '''Full (N, n_magnets, n_params) geometries of a batch of candidates of shape (N, dim).'''
+        if phi.dim() == 3: return phi
+        if phi.size(-1) == (self.n_magnets * self.n_params):
+            return phi.view(-1, self.n_magnets, self.n_params)
+        N = phi.size(0)
+        new_phi = self.DEFAULT_PHI.to(phi.device, phi.dtype).expand(N, self.n_magnets, self.n_params)
+        new_phi = new_phi.index_put(
+            (torch.arange(N, device=phi.device)[:,None], self.params_idx[None,:,0], self.params_idx[None,:,1]),
+            phi
+        )
+
+        # The derived parameters are rebuilt column by column, out of place: writing into new_phi
+        # would modify tensors that autograd saved (torch.max, divisions) and break backward/jacrev.
+        cols = list(new_phi.unbind(-1))  # (N, n_magnets) each
+        def tail(k, value):  # column k with the magnets 1: replaced by value
+            return torch.cat([cols[k][:, :1], value], dim=1)
+
+        # new_phi[:,13] = new_phi[:,12] MIDDLE-GAP IDENTICAL ENTER-EXIT
+        cols[13] = tail(13, cols[12][:, 1:])
+
+        if self.use_diluted:
+
+            ###########################
+            # NO OPTIMIZATION ON Y AXIS:
+            ###########################
+
+            # ∆Yyoke,1 = ∆Yyoke,2 = 110% · max(∆Xcore,1, ∆Xcore,2)
+            row_max = torch.max(cols[2][:, 1:], cols[3][:, 1:]) * 1.1
+            cols[10] = tail(10, row_max)
+            cols[11] = tail(11, row_max)
+            # Yyoke,1 = Yyoke,2 ⇒ ∆Ycore,1 + ∆Yyoke,1 = ∆Ycore,2 + ∆Yyoke,2 → ∆Ycore,1 = ∆Ycore,2.
+            cols[5] = tail(5, cols[4][:, 1:])
+
+            if self.key and self.key.startswith("piet"):
+
                 ###########################
-                # NO OPTIMIZATION ON Y AXIS:
+                # PIET LINE FIXED:
                 ###########################
-                
-                # ∆Yyoke,1 = ∆Yyoke,2 = 110% · max(∆Xcore,1, ∆Xcore,2)
-                row_max = torch.max(new_phi[rows, 2], new_phi[rows, 3]) * 1.1
-                new_phi.index_put_((rows, torch.tensor([10])), row_max)
-                new_phi.index_put_((rows, torch.tensor([11])), row_max)
-                # Yyoke,1 = Yyoke,2 ⇒ ∆Ycore,1 + ∆Yyoke,1 = ∆Ycore,2 + ∆Yyoke,2 → ∆Ycore,1 = ∆Ycore,2.
-                new_phi.index_put_((rows, torch.tensor([5])), new_phi[rows, 4])
-                
-                if self.key and self.key.startswith("piet"):
-                    
-                    ###########################
-                    # PIET LINE FIXED:
-                    ###########################
-                    if self.n_magnets <7:                    
-                        piet = torch.tensor(self.params['Piet_solution'], dtype = new_phi.dtype, device=new_phi.device)
-                    else:
-                        piet = torch.tensor(self.params['Piet_solution_7'], dtype = new_phi.dtype, device=new_phi.device)
-                    
-                    values_8 = (piet[1:,2] * piet[1:,8] + piet[1:,6] + piet[1:,2] - new_phi[1:,12] - new_phi[1:,6] - new_phi[1:,2]) / new_phi[1:,2]
-                    new_phi = new_phi.index_put(
-                        (rows, torch.tensor([8])),
-                        values_8
-                    )
-                    values_9 = (piet[1:,3] * piet[1:,9] + piet[1:,7] + piet[1:,3] - new_phi[1:,13] - new_phi[1:,7] - new_phi[1:,3]) / new_phi[1:,3]
-                    new_phi = new_phi.index_put(
-                        (rows, torch.tensor([9])),
-                        values_9
-                    )   
-                elif self.key and self.key.startswith("stell"):
-                    #∆Xcore,2 = ∆Xcore,1
-                    new_phi = new_phi.index_put(
-                                                (rows, torch.tensor([3])),
-                                                new_phi[rows, 2]
-                                            )
-                    # X_yoke 1 = X_yoke2 => ∆Xcore,1 · (1 + Ryoke/core,1) = ∆Xcore,2 · (1 + Ryoke/core,2) => ∆Xcore,2 = ∆Xcore,1 · (1 + Ryoke/core,1)/ (1 + Ryoke/core,2)
-                    values_8 = (new_phi[rows, 3] * (1 + new_phi[rows, 9]) + new_phi[rows, 7] - new_phi[rows, 6] - new_phi[rows, 2])/(new_phi[rows, 2])
-                    #Ensure that the yoke is never less than 1
-                    new_phi.index_put_((rows, torch.tensor([8])), values_8)
-            
-            if self.fSC_mag:
-                # new_phi[1][3] = new_phi[1][2]
-                new_phi = new_phi.index_put(
-                    (torch.tensor([1]), torch.tensor([3])),
-                    new_phi[1, 2]
-                )
-                # new_phi[1][5] = new_phi[1][4]
-                new_phi = new_phi.index_put(
-                    (torch.tensor([1]), torch.tensor([5])),
-                    new_phi[1, 4]
-                )                
-        else:
-            new_phi = phi
-            
-        return new_phi.view(self.n_magnets, self.n_params)
-        
+                if self.n_magnets <7:
+                    piet = torch.tensor(self.params['Piet_solution'], dtype = new_phi.dtype, device=new_phi.device)
+                else:
+                    piet = torch.tensor(self.params['Piet_solution_7'], dtype = new_phi.dtype, device=new_phi.device)
+
+                cols[8] = tail(8, (piet[1:,2] * piet[1:,8] + piet[1:,6] + piet[1:,2] - cols[12][:,1:] - cols[6][:,1:] - cols[2][:,1:]) / cols[2][:,1:])
+                cols[9] = tail(9, (piet[1:,3] * piet[1:,9] + piet[1:,7] + piet[1:,3] - cols[13][:,1:] - cols[7][:,1:] - cols[3][:,1:]) / cols[3][:,1:])
+            elif self.key and self.key.startswith("stell"):
+                #∆Xcore,2 = ∆Xcore,1
+                cols[3] = tail(3, cols[2][:, 1:])
+                # X_yoke 1 = X_yoke2 => ∆Xcore,1 · (1 + Ryoke/core,1) = ∆Xcore,2 · (1 + Ryoke/core,2) => ∆Xcore,2 = ∆Xcore,1 · (1 + Ryoke/core,1)/ (1 + Ryoke/core,2)
+                cols[8] = tail(8, (cols[3][:,1:] * (1 + cols[9][:,1:]) + cols[7][:,1:] - cols[6][:,1:] - cols[2][:,1:])/(cols[2][:,1:]))
+
+        if self.fSC_mag:
+            # new_phi[1][3] = new_phi[1][2], new_phi[1][5] = new_phi[1][4]
+            for k, source in ((3, 2), (5, 4)):
+                cols[k] = torch.cat([cols[k][:, :1], cols[source][:, 1:2], cols[k][:, 2:]], dim=1)
+        new_phi = torch.stack(cols, -1)
+        return new_phi
+
     def _apply_deterministic_loss(self,phi,y):
         M = self.get_total_cost(phi)
         loss = self.cost_loss(M)*(y+1)
@@ -1343,63 +1833,67 @@ class ShipMuonShield():
         loss = loss.clamp(max=1E6)#soft_clamp(loss,1.E8)
         return loss
     
-    def get_constraints(self,phi):
-        def fn_pen(x): 
-            return torch.nn.functional.relu(x,inplace=False).pow(2)
-        phi = self.add_fixed_params(phi)
-        print("phi:", phi)
-        print("self.get_total_length(phi)",self.get_total_length(phi))
-        constraints = fn_pen((self.get_total_length(phi)-self.L0)*100)
-        print("constraint on L:", constraints)
-        wall_gap = 1 #cm
-        def get_cavern_bounds(z):
-            mask = z <= 2051.8 - 214.0
-            x_min = torch.where(mask, 356.0, 456.0)
-            y_min = torch.where(mask, 170.0, 336.0)
-            x_min = x_min - wall_gap
-            y_min = y_min - wall_gap
-            return x_min, y_min
-        Ymgap = torch.zeros(self.n_magnets, device=phi.device)
-        if self.fSC_mag: Ymgap[2] = self.SC_Ymgap
-        Z_out = torch.cumsum(phi[:,0] + 2*phi[:,1],dim=0)
-        Z_in = Z_out - 2*phi[:,1]
-        with torch.no_grad(): x_min, y_min = get_cavern_bounds(Z_in)
-        constraints = constraints + fn_pen(phi[:,2]+phi[:,8]*phi[:,2]+phi[:,6]+phi[:,12]-x_min)
-        constraints = constraints + fn_pen(phi[:,4]+phi[:,10]+Ymgap - y_min)
-        print("constaint in x:", constraints)
-        with torch.no_grad(): x_min, y_min = get_cavern_bounds(Z_out)
-        constraints = constraints + fn_pen(phi[:,3]+phi[:,9]*phi[:,3]+phi[:,7]+phi[:,13] -x_min)
-        constraints = constraints + fn_pen(phi[:,5]+phi[:,11]+Ymgap - y_min)
-        print("constaint in y:", constraints)
+    @staticmethod
+    def _cavern_bounds(z, wall_gap = 1):
+        mask = z <= 2051.8 - 214.0
+        x_min = torch.where(mask, 356.0, 456.0) - wall_gap
+        y_min = torch.where(mask, 170.0, 336.0) - wall_gap
+        return x_min, y_min
+
+    # Scale of each constraint inside the quadratic penalty
+    constraint_scales = {'length': 100, 'yoke_in': 1000, 'yoke_out': 1000}
+
+    def constraint_violations(self, phi):
+        '''Constraints of a batch of candidates of shape (N, dim), in the form g <= 0.
+        Returns a dict of (N, k) violation matrices, in the order of get_constraints_func.
+        Pure tensor ops (no I/O), so it can be used inside torch.func.jacrev.'''
+        phi = self.add_fixed_params_batch(self._as_batch(phi))
+        g = {}
+        g['length'] = ((phi[...,1].sum(-1).mul(2) + phi[...,0].sum(-1)) / 100 - self.L0).unsqueeze(-1)
+        Ymgap = torch.zeros(self.n_magnets, device=phi.device, dtype=phi.dtype)
+        if self.fSC_mag: Ymgap[1] = self.SC_Ymgap
+        Z_out = torch.cumsum(phi[...,0] + 2*phi[...,1], dim=-1)
+        Z_in = Z_out - 2*phi[...,1]
+        with torch.no_grad(): x_min, y_min = self._cavern_bounds(Z_in)
+        g['x_in'] = phi[...,2] + phi[...,8]*phi[...,2] + phi[...,6] + phi[...,12] - x_min
+        g['y_in'] = phi[...,4] + phi[...,10] + Ymgap - y_min
+        with torch.no_grad(): x_min, y_min = self._cavern_bounds(Z_out)
+        g['x_out'] = phi[...,3] + phi[...,9]*phi[...,3] + phi[...,7] + phi[...,13] - x_min
+        g['y_out'] = phi[...,5] + phi[...,11] + Ymgap - y_min
         if self.use_diluted:
-            constraints = constraints + fn_pen((1-phi[:,8])*1000) 
-            constraints = constraints + fn_pen((1-phi[:,9])*1000)
-            print("phi[:,8]: ",phi[:,8])
-            print("phi[:,9]: ",phi[:,9])
-            print("constaint in yoke:", constraints)
-
-            if self.key.endswith("strong"):
-                print("strong Constraints")
-                X_yoke_out = phi[:,3] * (1 + phi[:,9]) + phi[:,7]
-                X_yoke_in =  phi[:,2] * (1 + phi[:,8]) + phi[:,6]
-                constraints[2:] += fn_pen(X_yoke_out[1:-1] - X_yoke_in[2:])
-                print("X_yoke_out: ", X_yoke_out)
-                print("X_yoke_in: ", X_yoke_in)
-            elif self.key.endswith("soft"):
-                print("soft Constraints")
-                X_yoke_out = phi[:,3] * (1 + phi[:,9]) + phi[:,7]
-                X_yoke_in =  phi[:,2] * (1 + phi[:,8]) + phi[:,6]
-                constraints[-1] +=  fn_pen(X_yoke_out.max() - X_yoke_out[-1])
-                print("X_yoke_out: ", X_yoke_out)
-                print("X_yoke_in: ", X_yoke_in)
-            print("constaint on yoke alignment:", constraints)
-            # assert False
+            g['yoke_in'] = 1 - phi[...,8]
+            g['yoke_out'] = 1 - phi[...,9]
+            X_yoke_out = phi[...,3] * (1 + phi[...,9]) + phi[...,7]
+            X_yoke_in = phi[...,2] * (1 + phi[...,8]) + phi[...,6]
+            if self.key and self.key.endswith("strong"):
+                g['yoke_alignment'] = X_yoke_out[...,1:-1] - X_yoke_in[...,2:]
+            elif self.key and self.key.endswith("soft"):
+                g['yoke_alignment'] = X_yoke_out.max(-1, keepdim=True).values - X_yoke_out[...,-1:]
         if self.cost_as_constraint:
-            M = self.get_total_cost(phi)
-            constraints = constraints + fn_pen(M - self.W0)
-        constraints = constraints.sum()*self.lambda_constraints
-        print("total constraint:", constraints)
-        return constraints.clamp(min=0,max=1E8)
+            M = torch.as_tensor(self.get_total_cost(phi), device=phi.device, dtype=phi.dtype)
+            g['cost'] = (M - self.W0).view(-1, 1)
+        return g
+
+    def constraint_penalty(self, g):
+        '''Quadratic penalty (N,) of the violations returned by constraint_violations.
+        The length and cost terms are counted once per magnet, as in the per-magnet sum it replaces.'''
+        penalty = 0
+        for name, value in g.items():
+            pen = fn_pen(value * self.constraint_scales.get(name, 1)).sum(-1)
+            if name in ('length', 'cost'): pen = pen * self.n_magnets
+            penalty = penalty + pen
+        return (penalty * self.lambda_constraints).clamp(min=0, max=1E8)
+
+    def evaluate_constraints(self, phi):
+        '''Violation matrices and penalty of a batch of candidates in a single pass.'''
+        g = self.constraint_violations(phi)
+        return g, self.constraint_penalty(g)
+
+    def get_constraints(self,phi):
+        '''Constraint penalty of one candidate (scalar) or of each candidate of a (N, dim) batch.'''
+        single = self._is_single(phi)
+        penalty = self.constraint_penalty(self.constraint_violations(phi))
+        return penalty[0] if single else penalty
 
     def get_constraints_func(self, phi):
         """
@@ -1407,54 +1901,9 @@ class ShipMuonShield():
         It takes a NumPy array (from SciPy) and returns a NumPy array where
         each element represents a constraint in the form `g(x) <= 0`.
         """
-        wall_gap = 1
-        def get_cavern_bounds(z):
-            x_min = torch.zeros_like(z)
-            y_min = torch.zeros_like(z)
-            mask = z <= 2051.8 - 214.0
-            x_min[mask] = 356
-            y_min[mask] = 170
-            x_min[~mask] = 456
-            y_min[~mask] = 336
-            x_min -= wall_gap
-            y_min -= wall_gap
-            return x_min, y_min
-
-        #phi = torch.from_numpy(phi).float()
-        
-        phi = self.add_fixed_params(phi)
-        
-        constraint_values = []
-        length_constraint = self.L0 - self.get_total_length(phi)
-        constraint_values.append(length_constraint)
-        z = torch.zeros(phi.size(0))
-        z = z + 2 * phi[:,1] + phi[:,0]
-        Ymgap = self.SC_Ymgap if (self.fSC_mag and abs(phi[:,-1])>3.0) else 0
-
-        with torch.no_grad():
-            x_min_g1, y_min_g1 = get_cavern_bounds(z - 2 * phi[:,1])
-        c1 = x_min_g1 - (phi[:,2] + phi[:,8] * phi[:,2] + phi[:,6] + phi[:,12])
-        constraint_values.append(c1)
-        c2 = y_min_g1 - (phi[:,4] + phi[:,10] + Ymgap)
-        constraint_values.append(c2)
-        with torch.no_grad():
-            x_min_g2, y_min_g2 = get_cavern_bounds(z)
-        c3 = x_min_g2 - (phi[:,3] + phi[:,9] * phi[:,3] + phi[:,7] + phi[:,13])
-        constraint_values.append(c3)
-        c4 = y_min_g2 - (phi[:,5] + phi[:,11] + Ymgap)
-        constraint_values.append(c4)
-        if self.use_diluted:
-            c5 = phi[:,8] - 1
-            constraint_values.append(c5)
-            c6 = phi[:,9] - 1
-            constraint_values.append(c6)
-        if self.cost_as_constraint:
-            M = self.get_total_cost(phi)
-            c_cost = (self.W0 - M)
-            constraint_values.append(c_cost)
-
-        all_constraints_tensor = -torch.cat([c.flatten() for c in constraint_values])
-        return all_constraints_tensor
+        single = self._is_single(phi)
+        g = torch.cat(list(self.constraint_violations(phi).values()), dim=-1)
+        return g[0] if single else g
 
        
 def save_muons(muons:np.array,tag):
@@ -1465,8 +1914,12 @@ class ShipMuonShieldCluster(ShipMuonShield):
                  manager_ip=os.getenv('IP_GCLOUD'),
                  port=444,
                  local:bool = False,
+                 pipeline_depth:int = 2,
+                 local_latency:float = 0.0,
                  **kwargs) -> None:
         self.return_files_dir = kwargs.pop('results_dir', None)
+        self.pipeline_depth = pipeline_depth
+        self._dispatch_threads = None
         super().__init__(**kwargs)
 
         self.manager_cert_path = os.getenv('STARCOMPUTE_MANAGER_CERT_PATH')
@@ -1478,6 +1931,38 @@ class ShipMuonShieldCluster(ShipMuonShield):
             from starcompute.star_client import StarClient
             self.star_client = StarClient(self.server_url, self.manager_cert_path, 
                                     self.client_cert_path, self.client_key_path)
+        else:
+            task = partial(_cluster_task, self.run_muonshield, self.loss_kernel, self.muons_file, self._run_kwargs())
+            self.star_client = LocalStarClient(task, processes = self.cores, latency = local_latency,
+                                               results_dir = self.return_files_dir)
+    def start(self):
+        # Simulations run on the cluster, there are no local workers to warm up.
+        return self
+    def close(self):
+        super().close()
+        if isinstance(getattr(self, 'star_client', None), LocalStarClient): self.star_client.close()
+        if self._dispatch_threads is not None:
+            self._dispatch_threads.shutdown(wait=False)
+            self._dispatch_threads = None
+    @property
+    def per_chunk(self):
+        '''True if chunks are sent one by one through chunk_executor: only when straggler
+        duplication, adaptive chunking or a chunk timeout is enabled. Otherwise simulate
+        makes a single batched star_client.run call.'''
+        return self.straggler_factor is not None or self.chunker is not None or self.chunk_timeout is not None
+    @property
+    def chunk_executor(self):
+        '''Sends every chunk as its own star_client.run call from a thread, so slow chunks
+        can be duplicated (see ChunkExecutor). star_client.run is then called from several
+        threads at once and must be thread-safe: LocalStarClient is, StarClient must be
+        checked before enabling per_chunk. Duplicates that lose are not cancelled.'''
+        if self._chunk_executor is None:
+            self._dispatch_threads = ThreadPoolExecutor(2 * max(1, self.cores))  # room for duplicates
+            self._chunk_executor = ChunkExecutor(self._dispatch_threads.submit, self.straggler_factor,
+                                                 timeout = self.chunk_timeout, retries = self.chunk_retries)
+        return self._chunk_executor
+    def _run_chunk(self, inputs):
+        return self.star_client.run([inputs])[0]
         
     def sample_x_idx(self,phi = None, n_samples = None):
         if n_samples is None: n_samples = self.n_samples
@@ -1489,60 +1974,187 @@ class ShipMuonShieldCluster(ShipMuonShield):
     
     def simulate(self,phi:torch.tensor,
                  muons = None,
-                 idx = None):
+                 idx = None,
+                 simulate_fields = True,
+                 reduce = True,
+                 file = None):
         phi = self.add_fixed_params(phi).flatten()
+        if file == self.muons_file: file = None  # the workers read muons_file by default
         if muons is not None:
             n_samples = muons.shape[0] 
         elif idx is not None:
             n_samples = idx[1] - idx[0]
         else: n_samples = self.n_samples
-        if n_samples==0: n_samples = self.sample_x().shape[0]
+        if n_samples==0: n_samples = len(MuonSampler(file)) if file is not None else self.sample_x().shape[0]
         muons_idx = self.sample_x_idx(n_samples=n_samples)
         if idx is not None:
             muons_idx = [(start + idx[0], stop + idx[0]) for (start, stop) in muons_idx]
-        if not self.uniform_fields: 
+        if simulate_fields and not self.uniform_fields: 
             print('SIMULATING MAGNETIC FIELDS')
-            self.simulate_mag_fields(phi, cores = 9)
+            # The cluster workers read the map from the shared fields_file
+            fields_file = self.simulate_mag_fields(phi, cores = 9)
+            if fields_file != self.fields_file: shutil.copyfile(fields_file, self.fields_file)
         t1 = time.time()
-        inputs = split_array_idx(phi.detach().cpu(),muons_idx) 
-        result = self.star_client.run(inputs)
+        if self.chunker is not None:
+            # work stealing over index ranges, sized from the measured throughput
+            start = idx[0] if idx is not None else 0
+            inputs = ([phi.detach().cpu(), r] + ([file] if file is not None else []) for _, r in self.chunker.ranges([[(start, start + n_samples)]]))
+            slots, on_done = self.cores, lambda inp, result, seconds: self.chunker.record(inp[1][1] - inp[1][0], seconds)
+        else:
+            inputs = split_array_idx(phi.detach().cpu(),muons_idx, file = file) 
+            slots, on_done = None, None
+        if self.per_chunk: run = partial(self.chunk_executor.run, self._run_chunk, inputs, slots, on_done)
+        else: run = partial(self.star_client.run, list(inputs))
+        if self.return_files_dir is None:
+            result = run()
+        else:
+            # Output files are loaded and reduced as they arrive, while the run is in progress
+            keep_values = (not reduce) or self.reduction not in ('sum', 'mean')
+            watcher = ReturnFileWatcher(self.return_files_dir, keep_values = keep_values).start()
+            try: result = run()
+            except Exception:
+                watcher.stop()
+                raise
+            total, count, values = watcher.finish([filename for filename in result if filename != -1])
         print('SIMULATION FINISHED, took',time.time()-t1)
         if self.return_files_dir is not None:
-            results = []
-            for filename in result:
-                if filename == -1: continue
-                m_file = os.path.join(self.return_files_dir,f"outputs_{filename}.pkl")
-                results.append(torch.as_tensor(np.load(m_file),dtype=torch.get_default_dtype()))
-                os.remove(m_file)
-            result = torch.cat(results)
+            if not keep_values:
+                if self.reduction == 'sum': return torch.as_tensor(total, device = phi.device)
+                return torch.as_tensor(total / max(count, 1), device = phi.device)
+            result = torch.cat(values)
+        else: result = _concat_chunks(result)
         
         result = torch.as_tensor(result,device = phi.device)
+        if not reduce: return result
+        # per-muon values of all the chunks: the mean is weighted by chunk size, whatever the chunking
         if self.reduction == 'sum': result = result.sum(-1)
-        elif self.reduction == 'mean': result = result.mean(-1)
+        elif self.reduction == 'mean': result = result.sum(-1) / max(result.size(-1), 1)
         return result
-    
+
+    def simulate_batch(self, phi:torch.tensor, muons = None, idx = None, reduce = True):
+        '''Simulate several candidates one after the other on the cluster, pipelined: a background
+        thread generates the field maps of the next candidates (at most pipeline_depth ahead)
+        while the cluster simulates the current one. Returns the list of results.'''
+        phis = list(self._as_batch(phi))
+        if self.uniform_fields or len(phis) == 1:
+            return [self.simulate(p, muons, idx, reduce = reduce) for p in phis]
+        maps = queue.Queue(maxsize = self.pipeline_depth)
+        stop = threading.Event()  # set when the consumer is done, even if it failed
+        def put(item):
+            while not stop.is_set():
+                try: return maps.put(item, timeout = 0.1)
+                except queue.Full: continue
+        def produce():
+            try:
+                for i, p in enumerate(phis):
+                    if stop.is_set(): return
+                    file_name = None if self.field_maps is not None else self._candidate_fields_file(i, len(phis))
+                    put((i, self.simulate_mag_fields(self.add_fixed_params(p), cores = 9, file_name = file_name)))
+            except Exception as e:
+                put((None, e))
+        results = []
+        with (self.field_maps.hold() if self.field_maps is not None else nullcontext()):
+            producer = threading.Thread(target = produce, daemon = True)
+            producer.start()
+            try:
+                for _ in phis:
+                    i, fields_file = maps.get()
+                    if i is None: raise fields_file
+                    # The cluster workers read the map from the shared fields_file
+                    shutil.copyfile(fields_file, self.fields_file)
+                    results.append(self.simulate(phis[i], muons, idx, simulate_fields = False, reduce = reduce))
+            finally:
+                stop.set()
+                while not maps.empty(): maps.get_nowait()  # unblock a pending put
+                producer.join()  # at most the field map in progress
+        return results
+
+    def _simulate_waves(self, phi, n_samples = None):
+        '''Early-stopping version of simulate: the muon range is simulated in early_stop_waves
+        waves (in random order) and the returned values of all the chunks seen so far are treated
+        as iid. The evaluation stops, censored, once the lower confidence bound of the loss
+        (after the deterministic loss, if applied) exceeds stop_threshold.'''
+        if n_samples is None: n_samples = self.n_samples
+        waves = get_split_indices(self.early_stop_waves, n_samples)
+        values = []
+        for w, j in enumerate(torch.randperm(len(waves)).tolist()):
+            values.append(self.simulate(phi, idx = waves[j], simulate_fields = (w == 0), reduce = False).flatten())
+            v = torch.cat(values).to(torch.get_default_dtype())
+            f = (w + 1) / len(waves)
+            se = v.std() * np.sqrt(len(v) * (1 - f)) if len(v) > 1 else torch.tensor(float('inf'))
+            if self.reduction == 'sum': loss, se = v.sum() / f, se / f
+            else: loss, se = v.mean(), se / len(v)
+            if w + 1 == len(waves): break
+            lower = loss - self.early_stop_z * se
+            if self.apply_det_loss: lower = self._apply_deterministic_loss(phi, lower)
+            if lower > self.stop_threshold:
+                self.early_stop_stats['censored'] += 1
+                self.early_stop_stats['waves_saved'] += len(waves) - w - 1
+                print(f'Early stopping after {w + 1} of {len(waves)} waves')
+                break
+        self.early_stop_stats['evaluations'] += 1
+        self.last_censored = torch.tensor([w + 1 < len(waves)])
+        return loss
+
+    def _call_batch(self, phi):
+        '''Evaluate several candidates, overlapping field generation and cluster simulation
+        (see simulate_batch). Cached and infeasible candidates are not simulated.'''
+        phi = self._as_batch(phi)
+        y = torch.full((phi.size(0), 1), 1E6, device=phi.device)
+        self.last_censored = torch.zeros(phi.size(0), dtype=torch.bool)  # evaluated in full
+        keys = [self.evaluation_key(self.add_fixed_params(p), idx = self.muons_file) if self.cache is not None else None for p in phi]
+        pending = []
+        for i, p in enumerate(phi):
+            cached = self.cache.get(keys[i]) if keys[i] is not None else None
+            if cached is not None: y[i] = cached
+            else: pending.append(i)
+        if len(pending) == 0: return y
+        feasible = [i for i, ok in zip(pending, self.feasibility_gate(phi[pending]).tolist()) if ok]
+        if len(feasible) == 0: return y
+        try: losses = self.simulate_batch(phi[feasible])
+        except Exception as e:
+            print(f"Error occurred with inputs: {phi[feasible]}")
+            print(e)
+            raise
+        for i, loss in zip(feasible, losses):
+            if self.apply_det_loss: loss = self._apply_deterministic_loss(phi[i], loss)
+            y[i] = loss.to(torch.get_default_dtype()).view(-1)
+            if keys[i] is not None: self.cache.put(keys[i], y[i].cpu())
+        return y
+
     def __call__(self,phi,muons = None, file = None):
-        if phi.dim()>1 and not self.parallel:
-            y = []
-            for p in phi:
-                y.append(self(p))
+        if not self._is_single(phi):
+            if muons is None and file is None and not self.early_stopping:
+                return self._call_batch(phi)
+            y, censored = [], []
+            for p in self._as_batch(phi):
+                y.append(self(p, muons, file))
+                censored.append(self.last_censored)
+            self.last_censored = torch.cat(censored)
             return torch.stack(y)
         phi = self.add_fixed_params(phi)
-        M = self.get_total_cost(phi)
         if file is None: file = self.muons_file
-        if self.get_constraints(phi) > 10 or M>((6*np.log(10)/10+1)*self.W0): 
+        self.last_censored = torch.zeros(1, dtype=torch.bool)
+        key = self.evaluation_key(phi, muons, idx = file) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None: return cached.to(phi.device)
+        if self.is_infeasible(phi): 
             return torch.ones((1,1),device=phi.device)*1E6
-        try: loss = self.simulate(phi,muons, file)
+        try:
+            if self.early_stopping and self.stop_threshold is not None and muons is None:
+                loss = self._simulate_waves(phi)
+            else: loss = self.simulate(phi,muons, file = file)
         except Exception as e:
             print(f"Error occurred with input: {phi}")
             print(e)
             raise
-        n_samples = self.n_samples
-        
         
         if self.apply_det_loss: loss = self._apply_deterministic_loss(phi,loss)
 
-        return loss.to(torch.get_default_dtype())   
+        loss = loss.to(torch.get_default_dtype())
+        if key is not None and not self.last_censored.any(): self.cache.put(key, loss.cpu())
+        return loss
     
 class ShipMuonShieldCuda(ShipMuonShield):
     def __init__(self,
@@ -1554,7 +2166,10 @@ class ShipMuonShieldCuda(ShipMuonShield):
         from cuda_muons import run
         self.run_muonshield = run
         self.muons = super().sample_x()
+    def start(self):
+        return self
     def sample_x(self, phi=None, idx=None):
+        if self._crn_muons is not None: return self._crn_muons
         if 0 < self.n_samples < self.muons.size(0):
             indices = torch.randperm(self.muons.size(0), device=self.muons.device)[: self.n_samples]
             return self.muons[indices].clone()
@@ -1581,7 +2196,7 @@ class ShipMuonShieldCuda(ShipMuonShield):
                                         SND = self.SND,
                                         return_all = return_all,
                                         histogram_dir = os.path.join(PROJECTS_DIR, 'MuonsAndMatter/cuda_muons/data'),
-                                        seed = self.seed)
+                                        seed = self.seed if self._crn_seed is None else self._crn_seed)
         except Exception as e:
             print(f"Error during CUDA simulation with input: {phi}")
             print(e)
@@ -1596,6 +2211,15 @@ class ShipMuonShieldCuda(ShipMuonShield):
         weight = output['weight']
         return torch.stack([px, py, pz, x, y, z, particle, weight])    
 
+    def simulate_batch(self, phi:torch.tensor, muons = None, return_all = False, **kwargs):
+        '''The GPU simulation runs one geometry at a time.'''
+        if muons is None: muons = self.sample_x()
+        outputs = [self.simulate(p, muons, return_all) for p in self._as_batch(phi)]
+        self._last_fields_files = None
+        if kwargs.get('reduce', False):
+            return [self.loss_kernel.partials(out).view(1, -1) for out in outputs]
+        return outputs
+
 class stochastic_RosenbrockProblem(RosenbrockProblem):
     def __init__(self,bounds = (-10,10), 
                  n_samples:int = 1, 
@@ -1772,6 +2396,7 @@ if __name__ == '__main__':
     print(f"Number of hits WEIGHTED:   {factor[hits].sum().item()}")
     print(f"Simulation time:  {simulation_time:.2f}s")
     print(f"Total time:       {time.time() - t0:.2f}s")
+    muon_shield.close()
 
 
 
@@ -0,0 +1,74 @@
+import os
+from utils.cache import EvaluationCache
+
+
+def test_evaluation_cache_evicts_least_recently_used(tmp_path):
+    cache = EvaluationCache(str(tmp_path), max_bytes = 10**6)
+    for key in 'abc': cache.put(key, bytes(100))
+    entry = cache.nbytes // 3
+    cache.max_bytes = 3 * entry
+    assert cache.get('a') is not None  # a is now the most recent
+    cache.put('d', bytes(100))
+    assert 'b' not in cache and all(k in cache for k in 'acd')
+    assert cache.nbytes == 3 * entry
+    assert EvaluationCache(str(tmp_path)).nbytes == cache.nbytes  # the index is rebuilt from the directory
+
+
+def test_remove_drops_the_entry_and_its_bytes(tmp_path):
+    cache = EvaluationCache(str(tmp_path))
+    cache.put('partial', {(0, 10): 1.0})
+    cache.put('full', 2.0)
+    cache.remove('partial')
+    cache.remove('missing')
+    assert 'partial' not in cache and cache.get('partial') is None
+    assert len(cache) == 1 and cache.nbytes == (tmp_path / 'full.pkl').stat().st_size
+
+
+def test_entries_deleted_by_another_process_are_misses(tmp_path):
+    from utils.cache import FieldMapStore
+    store = FieldMapStore(str(tmp_path / 'fields'))
+    path = store.get_or_compute('a', lambda name: open(name, 'w').write('map'))
+    os.remove(path)  # evicted by another process sharing the directory
+    assert store.get('a') is None and len(store) == 0 and store.nbytes == 0
+    assert store.stats()['misses'] == 2
+    cache = EvaluationCache(str(tmp_path / 'cache'))
+    cache.put('k', 1.0)
+    os.remove(tmp_path / 'cache' / 'k.pkl')
+    assert 'k' not in cache and cache.get('k') is None and cache.nbytes == 0
+
+
+def test_held_field_maps_are_not_evicted(tmp_path):
+    from utils.cache import FieldMapStore
+    store = FieldMapStore(str(tmp_path))
+    write = lambda name: open(name, 'w').write('x' * 100)
+    store.get_or_compute('a', write)
+    store.max_bytes = store.nbytes
+    with store.hold():  # e.g. the maps of a batch being simulated
+        store.get('a')
+        store.get_or_compute('b', write)
+        assert store.get('a') is not None and store.get('b') is not None
+    assert store.get('a') is None and store.get('b') is not None
+
+
+def test_nested_holds_release_on_the_outermost_exit(tmp_path):
+    from utils.cache import FieldMapStore
+    store = FieldMapStore(str(tmp_path))
+    write = lambda name: open(name, 'w').write('x' * 100)
+    store.max_bytes = 0
+    with store.hold():
+        store.get_or_compute('a', write)
+        with store.hold(): store.get_or_compute('b', write)
+        assert store.get('a') is not None and store.get('b') is not None
+    assert store.get('a') is None and store.get('b') is None
+
+
+def test_array_fingerprint_samples_rows():
+    import numpy as np
+    from utils.cache import array_fingerprint
+    muons = np.random.default_rng(0).normal(size=(100_000, 8)).astype(np.float32)
+    assert array_fingerprint(muons) == array_fingerprint(muons.copy())
+    changed = muons.copy()
+    changed[-1, 0] += 1
+    assert array_fingerprint(changed) != array_fingerprint(muons)
+    assert array_fingerprint(muons[:-1]) != array_fingerprint(muons)
+    assert array_fingerprint(muons.astype(np.float64)) != array_fingerprint(muons)
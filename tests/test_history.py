@@ -0,0 +1,65 @@
+import pickle
+import torch
+
+from utils.history import HistoryJournal, HistoryBuffer, load_history
+
+
+def test_journal_records_censored_rows(tmp_path):
+    journal = HistoryJournal(str(tmp_path))
+    journal.append(torch.rand(3, 2), torch.rand(3, 1), censored = torch.tensor([False, True, False]))
+    journal.append(torch.rand(1, 2), torch.rand(1, 1))
+    journal.close()
+    records = HistoryJournal(str(tmp_path)).records()
+    assert [r['censored'] for r in records] == [False, True, False, False]
+
+
+def test_journal_replay_drops_torn_tail(tmp_path):
+    journal = HistoryJournal(str(tmp_path))
+    phi, y = torch.rand(4, 2), torch.rand(4, 1)
+    journal.append(phi[:3], y[:3], seed = 1)
+    journal.close()
+    with open(journal.path, 'ab') as f: f.write(b'\x10\x00\x00\x00torn')  # crash mid-record
+    journal = HistoryJournal(str(tmp_path))
+    replayed = journal.replay()
+    assert torch.allclose(replayed[0], phi[:3]) and torch.allclose(replayed[1], y[:3])
+    journal.append(phi[3:], y[3:])  # appended after the last valid record
+    journal.close()
+    assert torch.allclose(HistoryJournal(str(tmp_path)).replay()[0], phi)
+
+
+def test_journal_snapshot_and_load_history(tmp_path):
+    journal = HistoryJournal(str(tmp_path))
+    phi, y = torch.rand(5, 2), torch.rand(5, 1)
+    journal.append(phi[:3], y[:3])
+    journal.snapshot((phi[:3], y[:3]))
+    journal.append(phi[3:], y[3:])
+    journal.close()
+    assert journal.pending == 2 and len(journal) == 5
+    assert not (tmp_path / 'history_0.journal').exists()
+    history = load_history(str(tmp_path))
+    assert torch.allclose(history[0], phi) and torch.allclose(history[1], y)
+
+
+def test_history_buffer_grows_in_place():
+    history = HistoryBuffer(torch.zeros(1, 2), torch.zeros(1, 1), capacity = 2)
+    for i in range(1, 9):
+        history.append(torch.full((1, 2), float(i)), torch.full((1, 1), float(i)))
+    phi, y = history
+    assert len(history) == 2 and history.n_rows == 9 and history.capacity == 16
+    assert torch.equal(y.view(-1), torch.arange(9.)) and phi.shape == (9, 2)
+    assert torch.equal(phi[:, 0], torch.arange(9.))  # rows kept across the reallocations
+    assert history[:1][0].data_ptr() == history[0].data_ptr()  # views, no copies
+
+
+def test_history_buffer_promotes_dtypes():
+    history = HistoryBuffer(torch.zeros(2, 3, dtype=torch.float32), torch.zeros(2, 1, dtype=torch.int64))
+    history.append(torch.full((1, 3), 0.1, dtype=torch.float64), torch.full((1, 1), 0.5))
+    assert history[0].dtype == torch.float64 and history[0][-1, 0] == 0.1
+    assert history[1].dtype == torch.get_default_dtype() and history[1][-1, 0] == 0.5
+
+
+def test_history_buffer_pickles_as_a_tuple():
+    history = HistoryBuffer(torch.rand(3, 2), torch.rand(3, 1), capacity = 2)
+    restored = pickle.loads(pickle.dumps(history))
+    assert type(restored) is tuple and len(restored) == 2
+    assert all(torch.equal(a, b) and a.size(0) == 3 for a, b in zip(restored, history))
@@ -0,0 +1,38 @@
+import numpy as np
+
+from utils.muons import MuonSampler
+
+
+def _muon_file(tmp_path, n, seed):
+    # only the most energetic muons can reach the detector, half of them do
+    rng = np.random.default_rng(seed)
+    muons = rng.normal(size=(n, 8)).astype(np.float32)
+    muons[:, 2] = rng.exponential(50, n)
+    muons[:, 7] = rng.uniform(0.5, 1.5, n)
+    hit = (muons[:, 2] > np.quantile(muons[:, 2], 0.9)) & (rng.random(n) < 0.5)
+    muons[:, 6] = np.where(hit, 13, 22)  # pdg: the hit muons are tagged as muons
+    path = str(tmp_path / 'muons.npy')
+    np.save(path, muons)
+    return path, muons
+
+
+def _estimates(draw, n_draws):
+    # weighted number of hits of each sample; the weights of the sample already carry N/n
+    return np.array([(x[:, 7] * (x[:, 6] == 13)).sum() for x in (draw() for _ in range(n_draws))])
+
+
+def test_pilot_allocation_reduces_variance(tmp_path):
+    path, muons = _muon_file(tmp_path, 20000, 0)
+    n, n_draws = 500, 200
+    np.random.seed(0)  # unseeded samples draw their seed from numpy
+    truth = (muons[:, 7] * (muons[:, 6] == 13)).sum()
+    sampler = MuonSampler(path)
+    uniform = _estimates(lambda: sampler.sample(n), n_draws) * len(muons) / n
+    proportional = _estimates(lambda: sampler.sample_stratified(n), n_draws)  # sigma_h = 1
+    strata = sampler.get_strata()
+    indices, bounds = strata.pilot(50, np.random.default_rng(1))
+    tagged = muons[indices, 6] == 13
+    strata.update_from_hits([tagged[a:b].sum() for a, b in zip(bounds[:-1], bounds[1:])], np.diff(bounds))
+    stratified = _estimates(lambda: sampler.sample_stratified(n), n_draws)
+    assert abs(stratified.mean() - truth) < 3 * stratified.std() / np.sqrt(n_draws)  # still unbiased
+    assert stratified.var() < 0.5 * proportional.var() and proportional.var() < uniform.var()
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+import problems
+from optimizer import CMAESOptimizer
+
+PROBLEMS = {
+    'Rosenbrock': lambda: problems.RosenbrockProblem(dim = 3),
+    'Rosenbrock_stochastic_hits': lambda: problems.Rosenbrock_stochastic_hits(dim = 3, n_samples = 500),
+    'ThreeHump': lambda: problems.ThreeHump(),
+    'ThreeHump_stochastic_hits': lambda: problems.ThreeHump_stochastic_hits(n_samples = 500),
+    'G02': lambda: problems.G02Problem(dim = 4),
+    'HelicalValley': lambda: problems.HelicalValleyProblem(),
+    'HelicalValley_stochastic_hits': lambda: problems.HelicalValley_stochastic_hits(n_samples = 500),
+}
+
+
+@pytest.mark.parametrize('name', list(PROBLEMS))
+def test_cmaes_generation(name, tmp_path):
+    problem = PROBLEMS[name]()
+    bounds = torch.as_tensor(problem.GetBounds(), dtype = torch.get_default_dtype()).view(2, -1)
+    initial_phi = bounds.mean(0)
+    optimizer = CMAESOptimizer(problem, bounds, initial_phi, device = torch.device('cpu'), pop_size = 6,
+                               outputs_dir = str(tmp_path))
+    phi, loss = optimizer.optimization_iteration()
+    assert optimizer.n_calls() == 1 + 6
+    assert optimizer.history[1].shape == (7, 1) and torch.isfinite(optimizer.history[1]).all()
+    assert phi.shape == initial_phi.shape
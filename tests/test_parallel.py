@@ -0,0 +1,174 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from utils.parallel import EvaluationPool, ChunkExecutor, AdaptiveChunker
+
+
+def _square(x):
+    return x * x
+
+def _die_once(marker, x):
+    # the first task to run kills its worker without reporting back
+    try: fd = os.open(marker, os.O_CREAT | os.O_EXCL)
+    except FileExistsError: return x * x
+    os.close(fd)
+    os._exit(1)
+
+def _slow_die_once(marker, x):
+    time.sleep(0.3)  # every thread's map is in flight when the worker dies
+    return _die_once(marker, x)
+
+def _hang_once(marker, x):
+    # the first task to run never returns
+    try: fd = os.open(marker, os.O_CREAT | os.O_EXCL)
+    except FileExistsError: return x * x
+    os.close(fd)
+    time.sleep(3600)
+
+def _always_die(x):
+    os._exit(1)
+
+
+def test_pool_map_respawns_dead_worker(tmp_path):
+    from functools import partial
+    with EvaluationPool(2, poll_interval = 0.05) as pool:
+        assert pool.map(partial(_die_once, str(tmp_path / 'marker')), range(6)) == [x * x for x in range(6)]
+        assert pool.n_restarts == 1
+
+
+def test_pool_map_from_several_threads_restarts_once(tmp_path):
+    from functools import partial
+    fn = partial(_slow_die_once, str(tmp_path / 'marker'))
+    with EvaluationPool(2, poll_interval = 0.05) as pool, ThreadPoolExecutor(4) as threads:
+        results = list(threads.map(lambda i: pool.map(fn, range(i, i + 3)), range(4)))
+        assert results == [[x * x for x in range(i, i + 3)] for i in range(4)]
+        assert pool.n_restarts == 1
+
+
+def test_chunk_executor_recovers_dead_worker(tmp_path):
+    from functools import partial
+    with EvaluationPool(2) as pool:
+        executor = ChunkExecutor(pool.submit, None, poll_interval = 0.05, recover = pool.recover)
+        result = executor.run(partial(_die_once, str(tmp_path / 'marker')), range(6))
+        assert result == [x * x for x in range(6)]
+        assert pool.n_restarts == 1
+
+
+def test_chunk_executor_gives_up_on_dying_pool():
+    with EvaluationPool(1, max_restarts = 1) as pool:
+        executor = ChunkExecutor(pool.submit, None, poll_interval = 0.05, recover = pool.recover)
+        with pytest.raises(RuntimeError):
+            executor.run(_always_die, [1])
+
+
+def test_chunk_executor_retries_with_new_task():
+    calls = []
+    def fn(task):
+        calls.append(task)
+        if task[1] == 0: raise ValueError('bad seed')
+        return task
+    with ThreadPoolExecutor(4) as threads:
+        executor = ChunkExecutor(threads.submit, None, poll_interval = 0.01, retries = 2,
+                                 reseed = lambda task, attempt: (task[0], attempt))
+        assert executor.run(fn, [(0, 0), (1, 5)]) == [(0, 1), (1, 5)]
+    assert executor.stats['failures'] == 1 and executor.stats['retries'] == 1
+
+
+def test_chunk_executor_raises_after_retries():
+    def fn(task): raise ValueError('always')
+    with ThreadPoolExecutor(2) as threads:
+        executor = ChunkExecutor(threads.submit, None, poll_interval = 0.01, retries = 2)
+        with pytest.raises(ValueError):
+            executor.run(fn, [0])
+    assert executor.stats['failures'] == 3
+
+
+def test_chunk_executor_times_out_and_retries():
+    def fn(task):
+        if task == 'slow': time.sleep(1.0)
+        return task
+    with ThreadPoolExecutor(4) as threads:
+        executor = ChunkExecutor(threads.submit, None, poll_interval = 0.01, timeout = 0.1, retries = 1,
+                                 reseed = lambda task, attempt: 'fast')
+        assert executor.run(fn, ['a', 'slow']) == ['a', 'fast']
+    assert executor.stats['timeouts'] == 1
+
+
+def test_chunk_executor_restarts_pool_on_hung_chunk(tmp_path):
+    from functools import partial
+    pool = EvaluationPool(1).start()
+    try:
+        executor = ChunkExecutor(pool.submit, None, poll_interval = 0.05, recover = pool.recover,
+                                 timeout = 1.0, retries = 1, restart = pool.restart)
+        assert executor.run(partial(_hang_once, str(tmp_path / 'marker')), range(3)) == [0, 1, 4]
+        assert executor.stats['timeouts'] >= 1 and pool.n_restarts == 1  # queued chunks time out too
+    finally:
+        t0 = time.time()
+        pool.close()  # the hung worker is gone: nothing left to wait for
+    assert time.time() - t0 < 5
+
+
+def test_chunk_executor_duplicates_stragglers():
+    runs = []
+    def fn(task):
+        runs.append(task)
+        # the first run of the last chunk hangs well past the others; its duplicate does not
+        if task == 6 and runs.count(6) == 1: time.sleep(2.0)
+        else: time.sleep(0.01)
+        return task
+    with ThreadPoolExecutor(8) as threads:
+        executor = ChunkExecutor(threads.submit, 3.0, poll_interval = 0.01)
+        t0 = time.time()
+        assert executor.run(fn, range(7)) == list(range(7))
+        assert time.time() - t0 < 1.5
+    assert executor.stats['speculative_launched'] >= 1 and executor.stats['speculative_won'] == 1
+
+
+def test_adaptive_chunker_covers_spans():
+    chunker = AdaptiveChunker(4, target_time = 0.01, min_size = 10)
+    chunker.record(1000, 1.0)
+    spans = [[(0, 500)], [(100, 200), (300, 1000)]]
+    covered = [[], []]
+    for owner, (start, stop) in chunker.ranges(spans):
+        assert stop - start >= 1
+        covered[owner].append((start, stop))
+    for owner, span in enumerate(spans):
+        merged = []
+        for start, stop in sorted(covered[owner]):
+            if merged and merged[-1][1] == start: merged[-1] = (merged[-1][0], stop)
+            else: merged.append((start, stop))
+        assert merged == span
+
+
+_SHARED_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {root!r})
+import numpy as np
+from utils.parallel import EvaluationPool, SharedMuonBuffer, attach_muons
+
+def task(descriptor):
+    return float(attach_muons(*descriptor).sum())
+
+if __name__ == '__main__':
+    buffer = SharedMuonBuffer(np.ones((10, 8), dtype=np.float32))
+    pool = EvaluationPool(2)
+    if {fork_first}: pool.start()
+    if {fork_first}: buffer = SharedMuonBuffer(np.ones((10, 8), dtype=np.float32))
+    print(pool.map(task, [buffer.descriptor(0, 5), buffer.descriptor(5, 10)]))
+    pool.close()  # workers exit: their trackers must not unlink the parent's segment
+    attach_muons(*buffer.descriptor())  # raises if the segment was unlinked
+    buffer.close()
+    time.sleep(0.5)  # let the tracker process the unregistration
+'''
+
+
+@pytest.mark.parametrize('fork_first', [False, True])
+def test_shared_buffer_cleanup_stays_with_the_parent(tmp_path, fork_first):
+    import subprocess, sys
+    script = tmp_path / 'shared.py'
+    script.write_text(_SHARED_SCRIPT.format(root = os.path.dirname(os.path.dirname(os.path.abspath(__file__))), fork_first = fork_first))
+    result = subprocess.run([sys.executable, str(script)], capture_output = True, text = True, timeout = 60)
+    assert result.returncode == 0, result.stderr
+    assert '[40.0, 40.0]' in result.stdout
+    assert 'KeyError' not in result.stderr and 'leaked' not in result.stderr
@@ -0,0 +1,186 @@
+import os
+import numpy as np
+import pytest
+import torch
+from functools import partial
+
+from problems import _cluster_task, _concat_chunks
+from utils import split_array_idx, get_split_indices
+from utils.parallel import LocalStarClient
+
+
+def _fake_run(muons, params, **kwargs):
+    # only the muons with px > 0 reach the sensitive plane: (px, weight) of each
+    return muons[muons[:, 0] > 0][:, [0, 7]]
+
+
+def _kernel(px, weight):
+    return px * weight
+
+
+def _muon_file(tmp_path, name, n, seed):
+    muons = np.random.default_rng(seed).normal(size=(n, 8)).astype(np.float32)
+    path = str(tmp_path / name)
+    np.save(path, muons)
+    return path, muons
+
+
+def _expected(muons):
+    hits = muons[muons[:, 0] > 0]
+    return torch.as_tensor(hits[:, 0] * hits[:, 7], dtype=torch.get_default_dtype())
+
+
+def test_local_star_client_on_muon_file(tmp_path):
+    path, muons = _muon_file(tmp_path, 'muons.npy', 20, 0)
+    other, other_muons = _muon_file(tmp_path, 'other.npy', 20, 1)
+    client = LocalStarClient(partial(_cluster_task, _fake_run, _kernel, path, {}), processes = 2)
+    try:
+        phi = torch.zeros(1, 15)
+        result = _concat_chunks(client.run(split_array_idx(phi, get_split_indices(3, 20))))
+        assert torch.allclose(result, _expected(muons))
+        # the muon file travels with the chunk when it is not the default one
+        result = _concat_chunks(client.run(split_array_idx(phi, get_split_indices(3, 20), file = other)))
+        assert torch.allclose(result, _expected(other_muons))
+    finally:
+        client.close()
+
+
+def test_concat_chunks_of_different_lengths():
+    result = _concat_chunks([np.ones(3), np.zeros(0), np.full(2, 4.0)])
+    assert result.shape == (5,)
+    assert result.mean() == torch.tensor(11 / 5)
+
+
+def _bare_problem(muons_file, n_samples, subset_seed = None):
+    from problems import ShipMuonShield
+    problem = ShipMuonShield.__new__(ShipMuonShield)  # no simulation backend needed to sample muons
+    problem.muons_file, problem.n_samples, problem.subset_seed = muons_file, n_samples, subset_seed
+    problem.sampling, problem.strata, problem.strata_pilot, problem._strata_version = 'uniform', (8, 4), 0, 0
+    problem._crn_muons = problem._crn_key = problem._muon_sampler = problem._sample = None
+    return problem
+
+
+def test_deterministic_samples_are_reused(tmp_path):
+    path, muons = _muon_file(tmp_path, 'muons.npy', 20, 0)
+    full = _bare_problem(path, 0)
+    x = full.sample_x()
+    assert full.sample_x() is x and torch.equal(x, torch.from_numpy(muons))
+    assert full._muons_key(x) == full._muons_key(full.sample_x())
+    seeded = _bare_problem(path, 5, subset_seed = 3)
+    assert seeded.sample_x() is seeded.sample_x()
+    random = _bare_problem(path, 5)
+    assert random.sample_x() is not random.sample_x()
+
+
+def test_stratified_sample_follows_pilot_hit_rates(tmp_path):
+    path, muons = _muon_file(tmp_path, 'muons.npy', 400, 0)
+    problem = _bare_problem(path, 100, subset_seed = 3)
+    problem.sampling, problem.strata_pilot, problem.DEFAULT_PHI = 'stratified', 10, torch.zeros(2, 15)
+    def simulate_batch(phi, muons, reduce, chunks):
+        # the muons with px > 1 hit: (loss, weight, hits, outputs) partials per chunk
+        return [torch.tensor([[0, 0, (muons[a:b, 0] > 1).sum(), 0] for a, b in chunks], dtype=torch.float)]
+    problem.simulate_batch = simulate_batch
+    x = problem.sample_x()
+    strata = problem._muon_sampler.strata
+    assert problem._strata_version == 1 and strata.version == 1 and problem.sample_x() is x
+    assert strata.sigma.max() > 2 * strata.sigma.min()  # fewer samples where no muon hits
+
+
+def _geometry_problem(key, use_diluted = True, fSC_mag = False):
+    from problems import ShipMuonShield
+    problem = ShipMuonShield.__new__(ShipMuonShield)  # geometry only, no simulation backend
+    problem.key, problem.use_diluted, problem.fSC_mag = key, use_diluted, fSC_mag
+    problem.params_idx = torch.tensor(ShipMuonShield.parametrization[key])
+    if problem.params_idx[:, 0].max() >= len(ShipMuonShield.DEFAULT_PHI):
+        problem.DEFAULT_PHI = torch.tensor(ShipMuonShield.params['Piet_solution_7'])
+    problem.n_magnets = len(problem.DEFAULT_PHI)
+    return problem
+
+
+@pytest.mark.parametrize('key', ['piet', 'stellatryon_soft'])
+def test_diluted_geometry_is_differentiable(key):
+    problem = _geometry_problem(key)
+    phi = problem.DEFAULT_PHI[problem.params_idx[:, 0], problem.params_idx[:, 1]].repeat(2, 1).requires_grad_()
+    full = problem.add_fixed_params_batch(phi)
+    full.sum().backward()
+    assert phi.grad is not None and torch.isfinite(phi.grad).all()
+    jac = torch.func.jacrev(lambda p: problem.add_fixed_params_batch(p).sum(-1))(phi.detach())
+    assert torch.isfinite(jac).all()
+    full = full.detach()
+    assert torch.equal(full[:, 1:, 10], full[:, 1:, 11])
+    assert torch.equal(full[:, 1:, 5], full[:, 1:, 4]) and torch.equal(full[:, 1:, 13], full[:, 1:, 12])
+
+
+class _RecordingClient():
+    def __init__(self):
+        self.calls = []
+    def run(self, inputs):
+        self.calls.append(len(inputs))
+        return [np.ones(inp[1][1] - inp[1][0]) for inp in inputs]
+
+
+@pytest.mark.parametrize('straggler_factor', [None, 3.0])
+def test_cluster_chunks_are_batched_unless_speculation_is_enabled(straggler_factor):
+    from problems import ShipMuonShieldCluster
+    problem = ShipMuonShieldCluster.__new__(ShipMuonShieldCluster)  # no cluster connection needed
+    problem.n_magnets, problem.n_params, problem.cores, problem.parallel = 2, 15, 4, False
+    problem.muons_file, problem.n_samples, problem.uniform_fields = None, 40, True
+    problem.chunker, problem.chunk_timeout, problem.chunk_retries = None, None, 0
+    problem.straggler_factor, problem.return_files_dir, problem.reduction = straggler_factor, None, 'sum'
+    problem._chunk_executor = problem._dispatch_threads = None
+    problem.star_client = _RecordingClient()
+    try: assert problem.simulate(torch.zeros(30)) == 40
+    finally:
+        if problem._dispatch_threads is not None: problem._dispatch_threads.shutdown()
+    assert problem.star_client.calls == ([4] if straggler_factor is None else [1] * 4)
+
+
+def test_early_stopping_waves_keep_the_first_wave_maps(tmp_path):
+    from problems import ShipMuonShield
+    from utils.cache import FieldMapStore
+    problem = ShipMuonShield.__new__(ShipMuonShield)  # the simulation is replaced below
+    problem.field_maps = FieldMapStore(str(tmp_path), max_bytes = 0)  # anything not held is evicted
+    problem.early_stop_waves, problem.early_stop_z, problem.stop_threshold = 3, 3.0, float('inf')
+    problem.reduction, problem._crn_seed, problem.n_magnets, problem.n_params = 'sum', None, 2, 15
+    problem.early_stop_stats = {'evaluations': 0, 'censored': 0, 'waves_saved': 0}
+    def simulate_batch(phi, muons, reduce, fields_files):
+        with problem.field_maps.hold():  # as the real simulate_batch
+            if fields_files is None:
+                fields_files = [problem.field_maps.get_or_compute(i, lambda name: open(name, 'w').write('map')) for i in range(len(phi))]
+                problem._last_fields_files = fields_files
+            assert all(os.path.exists(f) for f in fields_files)
+        problem._partial_keys = [[] for _ in phi]
+        return [torch.ones(1, 4) for _ in phi]
+    problem.simulate_batch = simulate_batch
+    losses, censored = problem._simulate_waves(torch.zeros(2, 3), torch.ones(6, 8))
+    assert not any(censored) and problem.early_stop_stats['evaluations'] == 2
+
+
+def test_cluster_pipeline_stops_the_producer_on_failure(tmp_path):
+    import threading
+    from problems import ShipMuonShieldCluster
+    problem = ShipMuonShieldCluster.__new__(ShipMuonShieldCluster)  # no cluster connection needed
+    problem.n_magnets, problem.n_params, problem.pipeline_depth = 2, 15, 1
+    problem.uniform_fields, problem.field_maps, problem.fields_file = False, None, str(tmp_path / 'fields.h5')
+    def simulate_mag_fields(phi, cores, file_name):
+        open(file_name, 'w').write('map')
+        return file_name
+    def simulate(*args, **kwargs): raise RuntimeError('cluster down')
+    problem.simulate_mag_fields, problem.simulate = simulate_mag_fields, simulate
+    before = set(threading.enumerate())
+    with pytest.raises(RuntimeError, match = 'cluster down'):
+        problem.simulate_batch(torch.zeros(6, 30))
+    assert set(threading.enumerate()) <= before  # the producer is not left blocked on the full queue
+
+
+def test_stochastic_problem_cache_keeps_the_noise(tmp_path):
+    from problems import Rosenbrock_stochastic_hits
+    from utils.cache import EvaluationCache
+    problem = Rosenbrock_stochastic_hits(n_samples = 1000, cache = EvaluationCache(str(tmp_path)))
+    phi = torch.zeros(2)
+    torch.manual_seed(0)
+    first, second, after = problem(phi), problem(phi), torch.rand(1)
+    assert first != second  # a fresh draw, not the cached value
+    torch.manual_seed(0)  # a replay of the same random stream hits the cache
+    assert problem(phi) == first and problem(phi) == second and torch.equal(torch.rand(1), after)
+    assert problem.cache.stats()['hits'] == 2
@@ -0,0 +1,60 @@
+import h5py
+import numpy as np
+import pytest
+
+from utils import stitch_field_maps, FIELD_MAP_SCHEMA
+
+SCHEMA = dict(FIELD_MAP_SCHEMA, grids = {'B_grid': 2})
+
+
+def _write_map(path, z_range, order = 'zyx', **attrs):
+    '''Small synthetic field map over x in [0, 2], y in [0, 1] and z in z_range (step 1), its rows
+    ordered with order[0] the slowest axis.'''
+    axes = {'x': np.arange(0, 3.), 'y': np.arange(0, 2.), 'z': np.arange(z_range[0], z_range[1] + 1.)}
+    grid = np.meshgrid(*(axes[a] for a in order), indexing='ij')
+    points = np.stack([grid[order.index(a)].ravel() for a in 'xyz'], axis=1)
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('points', data=points)
+        f.create_dataset('B', data=np.stack([points[:, 0] * points[:, 2], points[:, 1] - points[:, 2], points.sum(1)], axis=1))
+        f.create_dataset('B_grid', data=(points.sum(1)).reshape(*(len(axes[a]) for a in order)).transpose(*(order.index(a) for a in 'xyz')))
+        f.create_dataset('version', data=3)
+        f.attrs['d_space'] = np.array([[0, 2], [0, 1], list(z_range)])
+        f.attrs['n_points'] = len(points)
+        f.attrs.update(attrs)
+    return str(path)
+
+
+@pytest.mark.parametrize('order', ['zyx', 'xyz'])
+def test_stitched_map_equals_monolithic(tmp_path, order):
+    whole = _write_map(tmp_path / 'whole.h5', (-2, 5), order)
+    slabs = [_write_map(tmp_path / f'slab_{i}.h5', z, order) for i, z in enumerate([(-2, 0), (1, 1), (2, 5)])]
+    stitched = stitch_field_maps(slabs, str(tmp_path / 'stitched.h5'), SCHEMA)
+    with h5py.File(whole, 'r') as a, h5py.File(stitched, 'r') as b:
+        assert set(a) == set(b) and set(a.attrs) == set(b.attrs)
+        for name in a: assert np.array_equal(a[name][()], b[name][()]), name
+        for key in a.attrs: assert np.array_equal(a.attrs[key], b.attrs[key]), key
+
+
+def test_overlapping_slabs_are_rejected(tmp_path):
+    slabs = [_write_map(tmp_path / 'a.h5', (0, 2)), _write_map(tmp_path / 'b.h5', (2, 4))]
+    with pytest.raises(ValueError):
+        stitch_field_maps(slabs, str(tmp_path / 'stitched.h5'), SCHEMA)
+
+
+def test_metadata_outside_the_schema_must_match(tmp_path):
+    slabs = [_write_map(tmp_path / 'a.h5', (0, 1), resolution = 1.0), _write_map(tmp_path / 'b.h5', (2, 4), resolution = 2.0)]
+    with pytest.raises(ValueError, match = 'resolution'):
+        stitch_field_maps(slabs, str(tmp_path / 'stitched.h5'), SCHEMA)
+    with pytest.raises(ValueError, match = 'B_grid'):  # not declared as a grid array
+        stitch_field_maps([_write_map(tmp_path / f'{i}.h5', z) for i, z in enumerate([(0, 1), (2, 4)])], str(tmp_path / 'stitched.h5'))
+
+
+
+def test_missing_ranges_of_stored_chunks():
+    # the ranges a retried or resumed evaluation still has to simulate
+    from utils import missing_ranges
+    assert missing_ranges({(6, 8): 0, (0, 3): 0, (3, 6): 0}, 0, 10) == [(8, 10)]  # any order, adjacent
+    assert missing_ranges({(2, 4): 0, (6, 8): 0}, 0, 10) == [(0, 2), (4, 6), (8, 10)]
+    assert missing_ranges({(0, 5): 0}, 3, 8) == [(5, 8)]
+    assert missing_ranges({(0, 10): 0}, 3, 8) == []
+    assert missing_ranges({}, 3, 8) == [(3, 8)]
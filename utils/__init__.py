@@ -72,7 +72,7 @@ def split_array(arr, K):
     splits = np.split(arr, np.cumsum(sizes)[:-1])
     return splits
 
-def split_array_parallel(phi, arr, K_total):
+def split_array_parallel(phi, arr, K_total, return_owner = False):
     """
     Distributes a total of K_total workloads among the elements of phi.
     For each phi, it splits the array 'arr' into a calculated number of chunks.
@@ -81,16 +81,18 @@ def split_array_parallel(phi, arr, K_total):
         phi (iterable): An iterable of parameters.
         arr (np.ndarray): The NumPy array to be split for each workload.
         K_total (int): The total number of workloads (e.g., cores) to be created.
+        return_owner (bool): If True, each workload also carries the index of its phi.
 
     Returns:
         list: A list of workloads. The total length of the list will be K_total.
-              Each workload is a list [chunk_of_array, parameter_from_phi].
+              Each workload is a list [chunk_of_array, parameter_from_phi]
+              (or [chunk_of_array, parameter_from_phi, phi_index]).
     """
     num_phi = len(phi)
     if num_phi == 0:
         return []
-    if K_total < 0:
-        raise ValueError("Total number of workloads (K_total) cannot be negative.")
+    if K_total < num_phi:
+        raise ValueError("Total number of workloads (K_total) must be at least the number of phi.")
 
     # Determine how many workloads (splits) each phi element gets.
     # This distributes the remainder, just like in split_array.
@@ -100,15 +102,40 @@ def split_array_parallel(phi, arr, K_total):
 
     workloads = []
     # Iterate through each parameter in phi and its assigned number of splits.
-    for p, num_splits_for_p in zip(phi, splits_for_each_phi):
+    for i, (p, num_splits_for_p) in enumerate(zip(phi, splits_for_each_phi)):
         # For each phi, split the *entire* data array into its assigned number of chunks.
         array_chunks = split_array(arr, num_splits_for_p)
         for chunk in array_chunks:
             # Inverted the order to [data_chunk, phi_parameter]
-            workloads.append([chunk, p])
+            workloads.append([chunk, p, i] if return_owner else [chunk, p])
             
     return workloads
 
+def split_indices_parallel(num_phi, N, K_total):
+    """
+    Index version of split_array_parallel: distributes K_total workloads among num_phi
+    candidates and splits range(N) for each of them. Returns a list of (phi_index, (start, stop)).
+    """
+    if K_total < num_phi:
+        raise ValueError("Total number of workloads (K_total) must be at least the number of phi.")
+    workloads = []
+    for i in range(num_phi):
+        num_splits = K_total // num_phi + (1 if i < K_total % num_phi else 0)
+        workloads.extend((i, idx) for idx in get_split_indices(num_splits, N))
+    return workloads
+
+def missing_ranges(done, start, stop):
+    """
+    Sub-intervals of [start, stop) not covered by the (start, stop) ranges in done.
+    """
+    gaps, cursor = [], start
+    for a, b in sorted(done):
+        if a > cursor: gaps.append((cursor, min(a, stop)))
+        cursor = max(cursor, b)
+        if cursor >= stop: break
+    if cursor < stop: gaps.append((cursor, stop))
+    return gaps
+
 from scipy.spatial import ConvexHull
 def compute_solid_volume_numpy(vertices):
     vertices = np.asarray(vertices)
@@ -172,6 +199,15 @@ def compute_solid_volume(vertices):
     
     return total_volume
 
+def compute_prismatoid_volume(a1, b1, a2, b2, h):
+    """
+    Closed-form volume of a solid with an a1 x b1 rectangle at z=0 and an a2 x b2
+    rectangle at z=h, with edges varying linearly in z (prismoidal formula).
+    Works elementwise on tensors of any (broadcastable) shape and is differentiable.
+    :return: h/6 * (a1*b1 + a2*b2 + (a1+a2)*(b1+b2))
+    """
+    return h / 6 * (a1 * b1 + a2 * b2 + (a1 + a2) * (b1 + b2))
+
 def normalize_vector(x:torch.tensor, bounds:tuple):
     """
     Normalize a tensor x to the range defined by bounds.
@@ -194,6 +230,78 @@ def denormalize_vector(x:torch.tensor, bounds:tuple):
 
 def fn_pen(x): return torch.nn.functional.relu(x,inplace=False).pow(2)
 
+FIELD_MAP_SCHEMA = {
+    'points': 'points',          # (N, 3) x, y, z coordinates of the grid points
+    'z_range': {'d_space': 2},   # metadata holding a [z_start, z_end] pair, at this index (None: the value itself)
+    'counts': ('n_points',),     # metadata counting grid points: summed over the slabs
+    'grids': {},                 # (nx, ny, nz, ...) grid arrays: name -> z axis
+}
+
+def _grid_order(points):
+    """Axes of the grid from the slowest to the fastest varying along the rows."""
+    changes = [np.count_nonzero(np.diff(points[:, k])) for k in range(3)]
+    return sorted(range(3), key=lambda k: changes[k])
+
+def _stitch_metadata(name, values, schema):
+    """
+    Metadata of the stitched map. Values equal in every slab are kept; the z ranges and counts
+    named in the schema are merged (first start and last end, sums). Anything else that differs
+    between the slabs cannot be stitched.
+    """
+    values = [np.asarray(v) for v in values]
+    if all(v.shape == values[0].shape and np.array_equal(v, values[0]) for v in values): return values[0]
+    if any(v.shape != values[0].shape for v in values):
+        raise ValueError(f'Cannot stitch {name}: its shape differs between the field map slabs')
+    if name in schema['counts']: return sum(values)
+    if name in schema['z_range']:
+        i = schema['z_range'][name]
+        i = () if i is None else i
+        rest = [v.copy() for v in values]
+        for v in rest: v[i] = 0
+        if all(np.array_equal(v, rest[0]) for v in rest):
+            merged = values[0].copy()
+            merged[i] = [values[0][i][0], values[-1][i][1]]
+            return merged
+    raise ValueError(f'Cannot stitch {name}: it differs between the field map slabs')
+
+def stitch_field_maps(slab_files, file_name, schema = FIELD_MAP_SCHEMA):
+    """
+    Stitch field map slabs, ordered along z, into a single field map file, the same as the map
+    computed over the whole z range. The layout of the files is given by schema (see FIELD_MAP_SCHEMA).
+    Datasets with one row per grid point are concatenated and their rows put in the grid order of
+    the slabs (read from the points dataset, e.g. z slowest); the grid arrays of the schema are
+    concatenated along their z axis. Any other dataset or attribute must be the same in every
+    slab, or be a z range or count of the schema, see _stitch_metadata.
+    """
+    slabs = []
+    for slab in slab_files:
+        with h5py.File(slab, 'r') as f:
+            if schema['points'] not in f: raise ValueError(f'No {schema["points"]} dataset in {slab}: cannot check how its points are ordered')
+            slabs.append(({name: f[name][()] for name in f}, dict(f.attrs)))
+    if any(set(datasets) != set(slabs[0][0]) or set(attrs) != set(slabs[0][1]) for datasets, attrs in slabs):
+        raise ValueError('The field map slabs do not have the same datasets and attributes')
+    points = [datasets[schema['points']] for datasets, _ in slabs]
+    for a, b in zip(points[:-1], points[1:]):
+        if a[:, 2].max() >= b[:, 2].min(): raise ValueError('Field map slabs must be ordered along z and must not overlap')
+    order = _grid_order(points[0])
+    lexsort = lambda p: np.lexsort([p[:, k] for k in reversed(order)])  # the last key is the slowest
+    for slab, p in zip(slab_files, points):
+        if not np.array_equal(lexsort(p), np.arange(len(p))):
+            raise ValueError(f'The grid points of {slab} are not in a regular (ascending) grid order')
+    rows = lexsort(np.concatenate(points))
+    n_points = [len(p) for p in points]
+    with h5py.File(file_name, 'w') as out:
+        for name in slabs[0][0]:
+            values = [datasets[name] for datasets, _ in slabs]
+            if name in schema['grids']: data = np.concatenate(values, axis=schema['grids'][name])
+            elif all(np.ndim(v) > 0 and len(v) == n for v, n in zip(values, n_points)):
+                data = np.concatenate(values, axis=0)[rows]
+            else: data = _stitch_metadata(name, values, schema)
+            out.create_dataset(name, data=data)
+        for key in slabs[0][1]:
+            out.attrs[key] = _stitch_metadata(key, [attrs[key] for _, attrs in slabs], schema)
+    return file_name
+
 class HDF5Dataset(torch.utils.data.IterableDataset):
     """
     PyTorch IterableDataset for parallel HDF5 loading.
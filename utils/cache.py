@@ -0,0 +1,281 @@
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+
+def _update_hash(h, obj, decimals):
+    if torch.is_tensor(obj):
+        obj = obj.detach().cpu().numpy()
+    if isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj, dtype=np.float64)
+        if decimals is not None: arr = np.round(arr, decimals) + 0.0 # + 0.0 turns -0.0 into 0.0
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'{')
+        for k in sorted(obj, key=str):
+            h.update(str(k).encode())
+            _update_hash(h, obj[k], decimals)
+        h.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for o in obj: _update_hash(h, o, decimals)
+        h.update(b']')
+    else:
+        h.update(repr(obj).encode())
+        h.update(b';')
+
+def hash_key(*parts, decimals:int = 6):
+    '''Stable hex digest of tensors, arrays and (nested) config values.
+    Arrays are hashed as float64 rounded to `decimals`, so float32 and float64
+    copies of the same point give the same key.'''
+    h = hashlib.sha1()
+    for p in parts:
+        _update_hash(h, p, decimals)
+    return h.hexdigest()
+
+
+def array_fingerprint(array, n_rows:int = 1024):
+    '''Cheap key of a large array (e.g. a muon sample): shape, dtype and about n_rows evenly
+    strided rows plus the last one, instead of hashing every element. Arrays that only
+    differ outside these rows share a fingerprint.'''
+    stride = max(1, len(array) // n_rows)
+    return hash_key('fingerprint', tuple(array.shape), str(array.dtype), array[::stride], array[-1:])
+
+
+class _DiskLRU():
+    '''Index of the files of a directory with size-bounded LRU eviction.
+    Recency is the file mtime, so it survives restarts and is shared by
+    processes using the same directory.'''
+    suffix = ''
+    def __init__(self, directory:str, max_bytes:int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._held = None
+        self._hold_depth = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index = OrderedDict()
+        self._bytes = 0
+        entries = []
+        for name in os.listdir(directory):
+            if not name.endswith(self.suffix) or '.tmp' in name: continue
+            st = os.stat(os.path.join(directory, name))
+            entries.append((st.st_mtime, name[:len(name)-len(self.suffix)], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}{self.suffix}')
+
+    def __contains__(self, key):
+        if os.path.exists(self._path(key)): return True
+        self._forget(key)  # evicted by another process
+        return False
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def _forget(self, key):
+        self._bytes -= self._index.pop(key, 0)
+
+    def _touch(self, key):
+        '''Mark key as recently used. False (and the entry is dropped) if its file is gone,
+        e.g. evicted by another process sharing the directory.'''
+        path = self._path(key)
+        try:
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            self._forget(key)
+            return False
+        if key not in self._index:  # written by another process
+            self._index[key] = size
+            self._bytes += size
+        self._index.move_to_end(key)
+        if self._held is not None: self._held.add(key)
+        return True
+
+    def _register(self, key):
+        self._bytes -= self._index.pop(key, 0)
+        self._index[key] = os.path.getsize(self._path(key))
+        self._bytes += self._index[key]
+        if self._held is not None: self._held.add(key)
+        self._evict(protect = key)
+
+    def remove(self, key):
+        '''Drop the entry of key, if there is one.'''
+        self._forget(key)
+        try: os.remove(self._path(key))
+        except FileNotFoundError: pass
+
+    def _evict(self, protect = None):
+        for key in list(self._index):
+            if self._bytes <= self.max_bytes: break
+            if key == protect or (self._held is not None and key in self._held): continue
+            self._bytes -= self._index.pop(key)
+            try: os.remove(self._path(key))
+            except FileNotFoundError: pass
+
+    @contextmanager
+    def hold(self):
+        '''Entries used inside this context are never evicted before it exits. Nested holds
+        share the held entries, which are released when the outermost one exits.'''
+        if self._hold_depth == 0: self._held = set()
+        self._hold_depth += 1
+        try: yield self
+        finally:
+            self._hold_depth -= 1
+            if self._hold_depth == 0:
+                self._held = None
+                self._evict()
+
+    def clear(self):
+        for key in list(self._index):
+            try: os.remove(self._path(key))
+            except FileNotFoundError: pass
+        self._index.clear()
+        self._bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self._index), 'bytes': self._bytes}
+
+
+class EvaluationCache(_DiskLRU):
+    '''Persistent, content-addressed cache of evaluation results.
+
+    Each entry is a pickle file named after its key inside `directory`,
+    the total size is bounded by `max_bytes` (least-recently-used eviction).'''
+    suffix = '.pkl'
+    def __init__(self, directory:str, max_bytes:int = 2**30):
+        super().__init__(directory, max_bytes)
+
+    def get(self, key, default = None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            self._forget(key)
+            self.misses += 1
+            return default
+        except (EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        self._touch(key)  # the value is loaded: a hit even if the file was evicted meanwhile
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp, path)
+        self._register(key)
+
+    def get_or_compute(self, key, fn):
+        value = self.get(key)
+        if value is None:
+            value = fn()
+            self.put(key, value)
+        return value
+
+
+class FieldMapStore(_DiskLRU):
+    '''Directory of magnetic field maps keyed by geometry, bounded by total disk size.
+    Every geometry gets its own file, so concurrent candidates never share a map.'''
+    suffix = '.h5'
+    def __init__(self, directory:str, max_bytes:int = 20*2**30):
+        super().__init__(directory, max_bytes)
+
+    def path(self, key):
+        return self._path(f'fields_{key}')
+
+    def get(self, key):
+        '''Path of the stored map for key, or None.'''
+        if not self._touch(f'fields_{key}'):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.path(key)
+
+    def get_or_compute(self, key, fn):
+        '''Return the path of the map for key, calling fn(file_name) to build it if missing.'''
+        path = self.get(key)
+        if path is not None: return path
+        path = self.path(key)
+        tmp = f'{path[:-len(self.suffix)]}.{os.getpid()}.tmp{self.suffix}'
+        fn(tmp)
+        os.replace(tmp, path)
+        self._register(f'fields_{key}')
+        return path
+
+
+class MemoLRU():
+    '''Bounded in-memory LRU memo of cheap-to-store results.
+    If `file` is given, the entries are loaded from it and written back
+    every `flush_every` new entries (and on flush()).'''
+    def __init__(self, maxsize:int = 4096, file:str = None, flush_every:int = 100):
+        self.maxsize = maxsize
+        self.file = file
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self._new = 0
+        self._data = OrderedDict()
+        if file is not None and os.path.exists(file):
+            try:
+                with open(file, 'rb') as f:
+                    self._data.update(pickle.load(f))
+            except (EOFError, pickle.UnpicklingError):
+                print(f'Could not read memo file {file}, starting empty')
+            while len(self._data) > self.maxsize: self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_or_compute(self, key, fn):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        value = fn()
+        self._data[key] = value
+        if len(self._data) > self.maxsize: self._data.popitem(last=False)
+        self._new += 1
+        if self.file is not None and self._new >= self.flush_every: self.flush()
+        return value
+
+    def flush(self):
+        if self.file is None or self._new == 0: return
+        tmp = f'{self.file}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(dict(self._data), f)
+        os.replace(tmp, self.file)
+        self._new = 0
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self._data)}
@@ -0,0 +1,208 @@
+import os
+import time
+import glob
+import pickle
+import struct
+import zlib
+import numpy as np
+import torch
+
+_FRAME = struct.Struct('<II')  # record length, crc32
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError: return
+    try: os.fsync(fd)
+    except OSError: pass
+    finally: os.close(fd)
+
+
+class HistoryJournal():
+    '''Append-only, fsync'd journal of the evaluations of an optimization run.
+
+    Every evaluation is one record {phi, y, time, fidelity, wall_time, seed, censored}, framed with
+    its length and CRC, so a record torn by a crash is detected and dropped on replay.
+    snapshot(history) compacts everything into history_snapshot.pkl (written atomically)
+    and starts a new journal generation; replay() is the snapshot plus the records
+    of the current journal.'''
+    snapshot_name = 'history_snapshot.pkl'
+    def __init__(self, directory:str, snapshot_every:int = 500):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+        self.generation, self._snapshot = 0, None
+        path = os.path.join(directory, self.snapshot_name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            self.generation, self._snapshot = state['generation'], state['history']
+        self._records, end = self._scan()
+        # drop a torn tail so that new records are appended after the last valid one
+        if os.path.exists(self.path) and os.path.getsize(self.path) > end:
+            print(f'Dropping a torn record at the end of {self.path}')
+            with open(self.path, 'r+b') as f: f.truncate(end)
+        self._file = None
+
+    @classmethod
+    def exists(cls, directory:str):
+        return os.path.exists(os.path.join(directory, cls.snapshot_name)) or \
+               len(glob.glob(os.path.join(directory, 'history_*.journal'))) > 0
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f'history_{self.generation}.journal')
+
+    @property
+    def pending(self):
+        '''Records written since the last snapshot.'''
+        return len(self._records)
+
+    def __len__(self):
+        return (len(self._snapshot[0]) if self._snapshot else 0) + len(self._records)
+
+    def _scan(self):
+        records, end = [], 0
+        if not os.path.exists(self.path): return records, end
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        while end + _FRAME.size <= len(data):
+            size, crc = _FRAME.unpack_from(data, end)
+            payload = data[end + _FRAME.size:end + _FRAME.size + size]
+            if len(payload) < size or zlib.crc32(payload) != crc: break
+            records.append(pickle.loads(payload))
+            end += _FRAME.size + size
+        return records, end
+
+    def append(self, phi, y, fidelity = None, wall_time:float = None, seed = None, censored = None):
+        '''Write one record per row of phi (N, d) / y (N, k), then fsync. fidelity may be a list (one per row);
+        censored (N,) flags the rows whose y is an early-stopped estimate rather than a full evaluation.'''
+        phi = np.asarray(torch.as_tensor(phi).detach().cpu()).reshape(-1, phi.shape[-1])
+        y = np.asarray(torch.as_tensor(y).detach().cpu()).reshape(len(phi), -1)
+        if not isinstance(fidelity, (list, tuple)): fidelity = [fidelity] * len(phi)
+        censored = [False] * len(phi) if censored is None else [bool(c) for c in torch.as_tensor(censored).view(-1)]
+        if self._file is None: self._file = open(self.path, 'ab')
+        now = time.time()
+        for p, v, fid, cens in zip(phi, y, fidelity, censored):
+            record = {'phi': p, 'y': v, 'time': now, 'fidelity': fid, 'wall_time': wall_time, 'seed': seed, 'censored': cens}
+            payload = pickle.dumps(record)
+            self._file.write(_FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+            self._records.append(record)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def snapshot(self, history:tuple):
+        '''Compact: atomically write history as the new snapshot and start an empty journal.'''
+        path = os.path.join(self.directory, self.snapshot_name)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            history = tuple(torch.as_tensor(t).clone() for t in history)  # no views of larger buffers
+            pickle.dump({'generation': self.generation + 1, 'history': history}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        _fsync_dir(self.directory)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        old = self.path
+        self.generation += 1
+        self._snapshot, self._records = history, []
+        if os.path.exists(old): os.remove(old)
+
+    def replay(self):
+        '''History tuple (phi, y) rebuilt from the snapshot and the journal records.'''
+        history = self._snapshot if self._snapshot else ()
+        if len(self._records) == 0: return history
+        dtype = torch.get_default_dtype()
+        phi = torch.as_tensor(np.stack([r['phi'] for r in self._records]), dtype=dtype)
+        y = torch.as_tensor(np.stack([r['y'] for r in self._records]), dtype=dtype)
+        if len(history) == 0: return (phi, y)
+        return (torch.cat([history[0].to(dtype), phi]), torch.cat([history[1].to(dtype), y]))
+
+    def last_phi(self):
+        if self._records: return self._records[-1]['phi']
+        if self._snapshot: return self._snapshot[0][-1]
+        return None
+
+    def records(self):
+        '''Records written since the last snapshot (with their fidelity, time, seed and censored flag).'''
+        return list(self._records)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_history(directory:str, pickle_name:str = 'history.pkl'):
+    '''History of a run: replay of its journal if there is one, else the legacy pickle.'''
+    if HistoryJournal.exists(directory):
+        journal = HistoryJournal(directory)
+        print(f'Replaying {len(journal)} evaluations from the history journal')
+        return journal.replay()
+    with open(os.path.join(directory, pickle_name), 'rb') as f:
+        return pickle.load(f)
+
+
+class HistoryBuffer():
+    '''Growable (phi, y[, x]) history with amortized O(1) appends.
+
+    Every field is kept in a preallocated tensor whose capacity doubles when full.
+    history[k] is a zero-copy view of the filled rows, so the buffer can stand in for
+    the tuple of tensors it replaces: indexing, slicing, len and unpacking behave the same,
+    and it pickles as a plain tuple of the trimmed tensors (readable without this class).
+    Appending rows of a wider dtype promotes the field (torch.promote_types), never downcasts.'''
+    def __init__(self, *tensors, capacity:int = 16):
+        self._buffers = []
+        self._n = 0
+        self._capacity = capacity
+        if len(tensors) > 0: self.append(*tensors)
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice): return tuple(self[i] for i in range(len(self))[k])
+        return self._buffers[k][:self._n]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __reduce__(self):
+        return (tuple, (tuple(t.clone() for t in self),))
+
+    @property
+    def n_rows(self):
+        return self._n
+
+    @property
+    def capacity(self):
+        return self._buffers[0].size(0) if self._buffers else 0
+
+    def _grow(self, n_rows):
+        capacity = max(self.capacity, self._capacity)
+        while capacity < n_rows: capacity *= 2
+        if capacity == self.capacity: return
+        for k, old in enumerate(self._buffers):
+            new = old.new_empty((capacity,) + tuple(old.shape[1:]))
+            new[:self._n] = old[:self._n]
+            self._buffers[k] = new
+
+    def append(self, *rows):
+        '''Append the rows of each field (same number of rows for all the fields).'''
+        rows = [torch.as_tensor(r) for r in rows]
+        if len(self._buffers) == 0:
+            self._buffers = [r.new_empty((0,) + tuple(r.shape[1:])) for r in rows]
+        assert len(rows) == len(self._buffers), f'Expected {len(self._buffers)} fields, got {len(rows)}'
+        n = rows[0].size(0)
+        assert all(r.size(0) == n for r in rows), 'All the fields need the same number of rows'
+        self._grow(self._n + n)
+        for k, r in enumerate(rows):
+            dtype = torch.promote_types(self._buffers[k].dtype, r.dtype)
+            if dtype != self._buffers[k].dtype: self._buffers[k] = self._buffers[k].to(dtype)
+            buffer = self._buffers[k]
+            buffer[self._n:self._n + n] = r.reshape((n,) + tuple(buffer.shape[1:]))
+        self._n += n
+        return self
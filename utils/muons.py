@@ -0,0 +1,267 @@
+import os
+import json
+import argparse
+from collections import OrderedDict
+import numpy as np
+import torch
+import h5py
+
+
+def sample_indices(n_total:int, n_samples:int, rng:np.random.Generator):
+    '''n_samples distinct indices of range(n_total), sorted for sequential page access.
+    Generator.choice does not permute the whole range, so the cost scales with n_samples.'''
+    idx = rng.choice(n_total, n_samples, replace=False)
+    idx.sort()
+    return idx
+
+def gather_rows(array, indices, out = None, chunk_size:int = 1 << 16):
+    '''Gather array[indices] (e.g. from a memmap) into a preallocated float32 buffer, chunk by chunk.'''
+    if out is None: out = np.empty((len(indices),) + array.shape[1:], dtype=np.float32)
+    for start in range(0, len(indices), chunk_size):
+        out[start:start+chunk_size] = array[indices[start:start+chunk_size]]
+    return out
+
+
+class MuonSampler():
+    '''Random muon subsets of a .npy (or .muons) file, read through a memory map.
+
+    Only the sampled rows are read from disk. Subsets drawn with an explicit
+    seed are reproducible and the last `max_cached` of them are kept in memory.
+    Columnar `.muons` files (see MuonStore) are sampled the same way.'''
+    def __init__(self, file:str, max_cached:int = 4):
+        self.file = file
+        self.array = MuonStore(file) if file.endswith(MuonStore.suffix) else np.load(file, mmap_mode='r')
+        self.max_cached = max_cached
+        self._subsets = OrderedDict()
+        self.strata = None
+
+    def __len__(self):
+        return len(self.array)
+
+    def sample(self, n_samples:int, idx:slice = slice(None), seed:int = None):
+        start, stop, step = idx.indices(len(self.array))
+        n = len(range(start, stop, step))
+        if not 0 < n_samples < n:
+            return np.array(self.array[idx], dtype=np.float32)
+        key = (n_samples, start, stop, step, seed)
+        if seed is not None and key in self._subsets:
+            self._subsets.move_to_end(key)
+            return self._subsets[key]
+        # Without a seed, draw it from the global numpy state so np.random.seed still applies
+        rng = np.random.default_rng(seed if seed is not None else np.random.randint(2**31))
+        x = gather_rows(self.array, start + step * sample_indices(n, n_samples, rng))
+        if seed is not None:
+            self._subsets[key] = x
+            if len(self._subsets) > self.max_cached: self._subsets.popitem(last=False)
+        return x
+
+    def sample_stratified(self, n_samples:int, idx:slice = slice(None), seed:int = None, bins:tuple = (8, 4)):
+        '''Stratified version of sample (see MuonStrata): the weight column of the
+        returned rows is rescaled by N_h/n_h so weighted sums stay unbiased.'''
+        start, stop, step = idx.indices(len(self.array))
+        n = len(range(start, stop, step))
+        if step != 1 or not 0 < n_samples < n:
+            return self.sample(n_samples, idx, seed)
+        self.get_strata(idx, bins)
+        key = ('stratified', n_samples, start, stop, tuple(bins), seed, self.strata.version)
+        if seed is not None and key in self._subsets:
+            self._subsets.move_to_end(key)
+            return self._subsets[key]
+        rng = np.random.default_rng(seed if seed is not None else np.random.randint(2**31))
+        indices, factors = self.strata.draw(n_samples, rng)
+        x = gather_rows(self.array, start + indices)
+        x[:, -1] *= factors
+        if seed is not None:
+            self._subsets[key] = x
+            if len(self._subsets) > self.max_cached: self._subsets.popitem(last=False)
+        return x
+
+    def get_strata(self, idx:slice = slice(None), bins:tuple = (8, 4)):
+        '''The MuonStrata of the rows idx (contiguous), built on first use and kept with their sigma.'''
+        start, stop, _ = idx.indices(len(self.array))
+        if self.strata is None or self.strata.range != (start, stop, tuple(bins)):
+            self.strata = MuonStrata(self.array, start, stop, bins)
+        return self.strata
+
+
+class MuonStrata():
+    '''Strata of a muon sample for stratified subsampling: quantile bins in momentum
+    times quantile bins in polar angle (bins = (n_momentum, n_angle)).
+
+    Samples are allocated per stratum with a Neyman-like rule,
+    n_h ~ sigma_h * sqrt(N_h * sum_h(w^2)), where sigma_h is a per-stratum scale
+    of the loss: 1 by default, set from the hit rates of a pilot sample with update_from_hits.'''
+    def __init__(self, array, start:int, stop:int, bins:tuple = (8, 4), chunk_size:int = 1 << 20):
+        self.range = (start, stop, tuple(bins))
+        n = stop - start
+        p = np.empty(n, dtype=np.float32)
+        theta = np.empty(n, dtype=np.float32)
+        w = np.empty(n, dtype=np.float32)
+        for s in range(0, n, chunk_size):
+            rows = np.asarray(array[start + s:start + min(s + chunk_size, n)], dtype=np.float32)
+            pt = np.hypot(rows[:, 0], rows[:, 1])
+            p[s:s + len(rows)] = np.hypot(pt, rows[:, 2])
+            theta[s:s + len(rows)] = np.arctan2(pt, np.abs(rows[:, 2]))
+            w[s:s + len(rows)] = rows[:, 7]
+        n_p, n_theta = bins
+        p_bin = np.searchsorted(np.quantile(p, np.linspace(0, 1, n_p + 1)[1:-1]), p, side='right')
+        theta_bin = np.searchsorted(np.quantile(theta, np.linspace(0, 1, n_theta + 1)[1:-1]), theta, side='right')
+        stratum = p_bin * n_theta + theta_bin
+        del p, theta
+        self.n_strata = n_p * n_theta
+        self.order = np.argsort(stratum, kind='stable')
+        self.counts = np.bincount(stratum, minlength=self.n_strata)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        self.sum_w2 = np.bincount(stratum, weights=w.astype(np.float64)**2, minlength=self.n_strata)
+        self.sigma = np.ones(self.n_strata)
+        self.version = 0  # number of sigma updates, part of the cache key of the samples
+
+    def update_sigma(self, sigma):
+        self.sigma = np.maximum(np.asarray(sigma, dtype=np.float64), 1e-12)
+        self.version += 1
+
+    def pilot(self, n_per_stratum:int, rng:np.random.Generator):
+        '''Indices (relative to start) of a pilot sample of at most n_per_stratum muons per stratum,
+        grouped by stratum, and the n_strata + 1 boundaries of the groups.'''
+        n_h = np.minimum(self.counts, n_per_stratum)
+        indices = [self.order[self.offsets[h]:self.offsets[h+1]][rng.choice(self.counts[h], n_h[h], replace=False)]
+                   for h in range(self.n_strata)]
+        return np.concatenate(indices), np.concatenate([[0], np.cumsum(n_h)])
+
+    def update_from_hits(self, hits, n):
+        '''Set sigma_h to the Bernoulli scale sqrt(p_h (1 - p_h)) of the hit rate measured on n_h
+        pilot muons of each stratum. p_h = (hits_h + 1/2) / (n_h + 1), so that a stratum without
+        hits in the pilot still gets samples.'''
+        p = (np.asarray(hits, dtype=np.float64) + 0.5) / (np.asarray(n, dtype=np.float64) + 1)
+        self.update_sigma(np.sqrt(p * (1 - p)))
+
+    def allocate(self, n_samples:int):
+        '''Number of samples per stratum, summing to n_samples and never above the stratum size.'''
+        score = self.sigma * np.sqrt(self.counts * self.sum_w2)
+        if score.sum() == 0: score = self.counts.astype(np.float64)
+        raw = n_samples * score / score.sum()
+        n_h = np.minimum(np.floor(raw).astype(np.int64), self.counts)
+        rest = n_samples - n_h.sum()
+        while rest > 0:  # largest remainders first, among strata with muons left
+            room = self.counts > n_h
+            frac = np.where(room, raw - n_h, -np.inf)
+            n_h[np.argsort(-frac)[:min(rest, room.sum())]] += 1
+            rest = n_samples - n_h.sum()
+        return n_h
+
+    def draw(self, n_samples:int, rng:np.random.Generator):
+        '''Sorted indices (relative to start) of a stratified sample and their weight factors N_h/n_h.'''
+        n_h = self.allocate(n_samples)
+        indices, factors = [], []
+        for h in np.flatnonzero(n_h):
+            members = self.order[self.offsets[h]:self.offsets[h+1]]
+            indices.append(members[rng.choice(self.counts[h], n_h[h], replace=False)])
+            factors.append(np.full(n_h[h], self.counts[h] / n_h[h], dtype=np.float32))
+        indices, factors = np.concatenate(indices), np.concatenate(factors)
+        order = np.argsort(indices)
+        return indices[order], factors[order]
+
+
+FEATURES = ("px", "py", "pz", "x", "y", "z", "pdg", "weight")
+_MAGIC = b'MUONCOL1'
+_ALIGN = 64
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+def _read_column(src, j, feature, start, stop):
+    if isinstance(src, h5py.File): return src[feature][start:stop]
+    return src[start:stop, j]
+
+def convert_muons(src_file:str, dst_file:str, pdg_dtype:str = 'int16', chunk_size:int = 1 << 22):
+    '''Convert a (n, 8) .npy or a per-feature .h5 muon file to the columnar .muons format.
+
+    Layout: magic, header length (uint64), JSON header with n_rows, total_weight and
+    the dtype/offset of every column, then each column contiguous and 64-byte aligned.
+    Kinematics and weight are float32, pdg is pdg_dtype (int16 or int8).'''
+    if src_file.endswith('.h5'):
+        src = h5py.File(src_file, 'r')
+        n_rows = src['px'].shape[0]
+    else:
+        src = np.load(src_file, mmap_mode='r')
+        n_rows = src.shape[0]
+    try:
+        dtypes = {f: np.dtype(pdg_dtype if f == 'pdg' else np.float32) for f in FEATURES}
+        total_weight = 0.0
+        for start in range(0, n_rows, chunk_size):
+            total_weight += float(np.sum(_read_column(src, 7, 'weight', start, start + chunk_size), dtype=np.float64))
+        header = {'n_rows': n_rows, 'total_weight': total_weight, 'columns': []}
+        # Offsets depend on the header size, which depends on the offsets: reserve room generously
+        header_size = _aligned(len(_MAGIC) + 8 + 256 + 96 * len(FEATURES))
+        offset = header_size
+        for f in FEATURES:
+            header['columns'].append({'name': f, 'dtype': dtypes[f].str, 'offset': offset})
+            offset = _aligned(offset + n_rows * dtypes[f].itemsize)
+        encoded = json.dumps(header).encode()
+        assert len(_MAGIC) + 8 + len(encoded) <= header_size, 'Muon file header too large'
+        tmp = f'{dst_file}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(_MAGIC)
+            out.write(np.uint64(len(encoded)).tobytes())
+            out.write(encoded)
+            for j, column in enumerate(header['columns']):
+                out.seek(column['offset'])
+                for start in range(0, n_rows, chunk_size):
+                    data = _read_column(src, j, column['name'], start, start + chunk_size)
+                    out.write(np.asarray(data).astype(dtypes[column['name']]).tobytes())
+            out.truncate(offset)
+        os.replace(tmp, dst_file)
+    finally:
+        if isinstance(src, h5py.File): src.close()
+    return dst_file
+
+
+class MuonStore():
+    '''Memory-mapped columnar muon file written by convert_muons.
+
+    Every feature is a separate contiguous column, so column(name) is a zero-copy
+    torch view and reading a few rows only touches the pages of those rows.
+    Indexing with a slice or an index array returns (n, 8) float32 rows in the
+    usual (px, py, pz, x, y, z, pdg, weight) order.'''
+    suffix = '.muons'
+    def __init__(self, file:str):
+        self.file = file
+        with open(file, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC: raise ValueError(f'{file} is not a columnar muon file')
+            size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            self.header = json.loads(f.read(size))
+        self.n_rows = self.header['n_rows']
+        self.total_weight = self.header['total_weight']
+        # copy-on-write maps: writable views for torch, the file itself is never modified
+        self.columns = {c['name']: np.memmap(file, dtype=np.dtype(c['dtype']), mode='c',
+                                             offset=c['offset'], shape=(self.n_rows,))
+                        for c in self.header['columns']}
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def shape(self):
+        return (self.n_rows, len(FEATURES))
+
+    def column(self, name:str):
+        return torch.from_numpy(self.columns[name])
+
+    def __getitem__(self, key):
+        first = self.columns[FEATURES[0]][key]
+        out = np.empty((len(first), len(FEATURES)), dtype=np.float32)
+        out[:, 0] = first
+        for j, f in enumerate(FEATURES[1:], start=1):
+            out[:, j] = self.columns[f][key]
+        return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a .npy/.h5 muon file to the columnar .muons format')
+    parser.add_argument('src', type=str)
+    parser.add_argument('dst', type=str)
+    parser.add_argument('--pdg_dtype', type=str, default='int16', choices=['int8', 'int16'])
+    args = parser.parse_args()
+    convert_muons(args.src, args.dst, args.pdg_dtype)
+    store = MuonStore(args.dst)
+    print(f'Wrote {store.n_rows} muons (total weight {store.total_weight:.4g}) to {args.dst}')
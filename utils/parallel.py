@@ -0,0 +1,506 @@
+import os
+import sys
+import time
+import uuid
+from functools import partial
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from statistics import median
+from multiprocessing import Pool, shared_memory, resource_tracker
+import numpy as np
+import torch
+
+
+class EvaluationPool():
+    '''Long-lived multiprocessing pool reused by every evaluation of a problem.
+
+    Workers are forked once (on start() or on the first map) and kept warm,
+    so the simulation libraries are imported only once per worker instead of
+    once per candidate. The pool is checked before each map and while waiting
+    for results: if a worker died, the pool is respawned and the map is
+    resubmitted (simulations are side-effect free, so this is safe).
+    map and submit may be called from several threads: starts and restarts are
+    serialised, and a map only restarts the pool it ran on, not one already
+    replaced by another thread.'''
+    def __init__(self, processes:int,
+                 initializer = None,
+                 initargs:tuple = (),
+                 poll_interval:float = 1.0,
+                 max_restarts:int = 3):
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.poll_interval = poll_interval
+        self.max_restarts = max_restarts
+        self.n_restarts = 0
+        self._pool = None
+        self._watched = []  # workers that may hold submitted tasks
+        self._lost = 0  # recoveries since the last completed submit
+        self._lock = threading.RLock()
+
+    @property
+    def running(self):
+        return self._pool is not None
+
+    def start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(self.processes, initializer = self.initializer, initargs = self.initargs)
+        return self
+
+    def close(self):
+        '''Gracefully stop the workers, waiting for pending tasks.'''
+        with self._lock: pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def terminate(self):
+        '''Kill the workers immediately.'''
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def restart(self):
+        with self._lock:
+            self.terminate()
+            self.n_restarts += 1
+            self._watched = []
+            return self.start()
+
+    def _restart_if(self, generation:int):
+        # restart, unless another thread already did since the pool of `generation` was seen
+        with self._lock:
+            if self.n_restarts == generation: self.restart()
+
+    def workers(self):
+        return list(self._pool._pool) if self._pool is not None else []
+
+    def is_healthy(self):
+        workers = self.workers()
+        return len(workers) == self.processes and all(w.is_alive() for w in workers)
+
+    def ensure_healthy(self):
+        with self._lock:
+            if self._pool is None: self.start()
+            elif not self.is_healthy():
+                print('Dead workers found in evaluation pool, respawning')
+                self.restart()
+        return self
+
+    def map(self, fn, iterable, chunksize:int = 1):
+        workloads = list(iterable)
+        for _ in range(self.max_restarts + 1):
+            with self._lock:
+                self.ensure_healthy()
+                generation, workers = self.n_restarts, self.workers()
+                result = self._pool.map_async(fn, workloads, chunksize)
+            while not result.ready():
+                result.wait(self.poll_interval)
+                if not result.ready() and any(w.exitcode is not None for w in workers):
+                    break
+            if result.ready():
+                return result.get()
+            print('A worker died during the evaluation, respawning pool and resubmitting')
+            self._restart_if(generation)
+        raise RuntimeError(f'Evaluation pool lost workers {self.max_restarts + 1} times in a row')
+
+    def _watch(self):
+        known = set(map(id, self._watched))
+        self._watched.extend(w for w in self.workers() if id(w) not in known)
+
+    def recover(self):
+        '''Respawn the pool if a worker died since the last restart; True if it did (the pending
+        submits are then lost and must be resubmitted). Pool replaces dead workers silently,
+        so the workers seen by submit are checked for an exit code, as map does.'''
+        with self._lock:
+            if self._pool is None: return False
+            self._watch()
+            if not any(w.exitcode is not None for w in self._watched): return False
+            self._lost += 1
+            if self._lost > self.max_restarts:
+                self.terminate()  # the queued tasks would keep killing the replacement workers
+                raise RuntimeError(f'Evaluation pool lost workers {self._lost} times in a row')
+            print('A worker died during the evaluation, respawning pool and resubmitting')
+            self.restart()
+            return True
+
+    def _done(self, future, result):
+        self._lost = 0
+        future.set_result(result)
+
+    def submit(self, fn, *args):
+        '''Run fn(*args) on a worker and return a concurrent.futures.Future of its result.
+        If the worker dies, the future never completes: poll recover() (see ChunkExecutor).'''
+        future = Future()
+        future.set_running_or_notify_cancel()  # pool tasks cannot be cancelled once queued
+        with self._lock:
+            self.ensure_healthy()
+            self._watch()
+            self._pool.apply_async(fn, args, callback = partial(self._done, future), error_callback = future.set_exception)
+        return future
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        # Pools cannot be pickled; a copy starts without workers.
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_watched'] = []
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+class SharedMuonBuffer():
+    '''Muon sample copied once into a named shared-memory segment.
+
+    Pool workers receive only descriptors (segment name, shape, dtype, row range)
+    and map the rows with attach_muons, so the sample is never pickled per evaluation.
+    The segment is unlinked by close().'''
+    def __init__(self, array:np.ndarray):
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(self.shape, dtype=array.dtype, buffer=self._shm.buf)[:] = array
+
+    @property
+    def name(self):
+        return self._shm.name if self._shm is not None else None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def descriptor(self, start:int = 0, stop:int = None):
+        '''Picklable reference to rows [start, stop) of the buffer.'''
+        return (self._shm.name, self.shape, self.dtype, start, len(self) if stop is None else stop)
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __del__(self):
+        try: self.close()
+        except Exception: pass
+
+
+_attached = {}
+_own_tracker = None  # whether this process runs its own resource tracker (None: not known yet)
+
+def _attach_segment(name:str):
+    '''Map an existing segment without taking over its cleanup, which stays with the parent.'''
+    global _own_tracker
+    if sys.version_info >= (3, 13): return shared_memory.SharedMemory(name=name, track=False)
+    # Forked workers share the tracker of the parent: unregistering there would drop the parent's
+    # own registration. Only a tracker started by this process (none inherited) must forget the
+    # segment, or it would unlink it when the worker exits.
+    if _own_tracker is None: _own_tracker = getattr(resource_tracker._resource_tracker, '_fd', None) is None
+    shm = shared_memory.SharedMemory(name=name)
+    if _own_tracker:
+        try: resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception: pass
+    return shm
+
+def attach_muons(name:str, shape:tuple, dtype:str, start:int, stop:int):
+    '''Worker side: read-only, zero-copy view of rows [start, stop) of a SharedMuonBuffer.
+    Attachments are kept per worker, so each segment is mapped once per process.'''
+    if name not in _attached:
+        for old in list(_attached):  # a new segment means the previous sample is gone
+            _attached.pop(old).close()
+        _attached[name] = _attach_segment(name)
+    view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_attached[name].buf)[start:stop]
+    view.flags.writeable = False
+    return view
+
+
+class ReturnFileWatcher():
+    '''Consume result files while a blocking cluster run is still in progress.
+
+    A background thread polls `directory` for `{prefix}{name}{suffix}` files written
+    after start() and loads them with `readers` parallel threads, keeping only their
+    running sum and count (and the arrays themselves if keep_values). finish(names)
+    loads whatever is still missing among the names returned by the run, deletes
+    those files and returns the reduction. Files of other runs are never deleted.'''
+    def __init__(self, directory:str, prefix:str = 'outputs_', suffix:str = '.pkl',
+                 poll_interval:float = 0.5, readers:int = 4, keep_values:bool = False):
+        self.directory = directory
+        self.prefix = prefix
+        self.suffix = suffix
+        self.poll_interval = poll_interval
+        self.keep_values = keep_values
+        self._readers = ThreadPoolExecutor(readers)
+        self._partials = {}
+        self._loading = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{self.prefix}{name}{self.suffix}')
+
+    def _load(self, name):
+        try: value = torch.as_tensor(np.load(self._path(name)), dtype=torch.get_default_dtype())
+        except (OSError, EOFError, ValueError):  # still being written: retry on the next poll
+            with self._lock: self._loading.discard(name)
+            return
+        with self._lock:
+            self._partials[name] = (value.sum(), value.numel(), value if self.keep_values else None)
+
+    def _poll(self):
+        while not self._stop.is_set():
+            for entry in os.scandir(self.directory):
+                if not (entry.name.startswith(self.prefix) and entry.name.endswith(self.suffix)): continue
+                name = entry.name[len(self.prefix):len(entry.name)-len(self.suffix)]
+                with self._lock:
+                    if name in self._loading: continue
+                    try:
+                        if entry.stat().st_mtime < self._t_start: continue
+                    except FileNotFoundError: continue
+                    self._loading.add(name)
+                self._readers.submit(self._load, name)
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        self._t_start = time.time() - 1
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+        self._readers.shutdown(wait=True)
+
+    def finish(self, names):
+        '''(total, count, values) over the files of names; values is None unless keep_values.'''
+        self.stop()
+        names = [str(n) for n in names]
+        missing = [n for n in names if n not in self._partials]
+        with ThreadPoolExecutor(max(1, min(len(missing), 8))) as readers:
+            list(readers.map(self._load, missing))
+        total, count, values = 0., 0, []
+        for n in names:
+            if n not in self._partials: raise FileNotFoundError(self._path(n))
+            s, c, v = self._partials.pop(n)
+            total, count = total + s, count + c
+            if v is not None: values.append(v)
+            os.remove(self._path(n))
+        return total, count, (values if self.keep_values else None)
+
+
+def _local_task(task_fn, latency, jitter, results_dir, inputs):
+    if latency > 0 or jitter > 0: time.sleep(latency + jitter * np.random.rand())
+    if results_dir is None: return task_fn(*inputs)
+    try: value = task_fn(*inputs)
+    except Exception as e:
+        print(f'Local task failed: {e}')
+        return -1
+    name = uuid.uuid4().hex
+    path = os.path.join(results_dir, f'outputs_{name}.pkl')
+    with open(f'{path}.tmp', 'wb') as f:
+        np.save(f, np.asarray(value))
+    os.replace(f'{path}.tmp', path)
+    return name
+
+
+class LocalStarClient():
+    '''Local stand-in for starcompute's StarClient, with the same run(inputs) contract.
+
+    Every input (e.g. [phi, (start, stop)] from split_array_idx) is passed to
+    task_fn(*input) in a process pool on this machine. Each task can be delayed by
+    latency + U(0, jitter) seconds to mimic transport. With results_dir, results are
+    written as outputs_{name}.pkl files and the names are returned (-1 for failed
+    tasks), like the cluster's return-files mode.'''
+    def __init__(self, task_fn, processes:int = None, latency:float = 0.0, jitter:float = 0.0, results_dir:str = None):
+        self.task_fn = task_fn
+        self.latency = latency
+        self.jitter = jitter
+        self.results_dir = results_dir
+        self.pool = EvaluationPool(processes if processes is not None else os.cpu_count())
+
+    def run(self, inputs):
+        task = partial(_local_task, self.task_fn, self.latency, self.jitter, self.results_dir)
+        return self.pool.map(task, inputs)
+
+    def close(self):
+        self.pool.close()
+
+
+class ChunkExecutor():
+    '''Run independent chunk tasks with speculative re-execution of stragglers.
+
+    `submit(fn, task)` must return a concurrent.futures.Future (EvaluationPool.submit,
+    ThreadPoolExecutor.submit). `tasks` may be a lazy iterable: with `slots`, at most that
+    many tasks are in flight and the next one is pulled whenever one finishes (work
+    stealing, see AdaptiveChunker).
+    With a straggler_factor, once no task is left to pull and half of them are done, any
+    chunk running longer than straggler_factor x the median chunk time gets a duplicate;
+    the first copy to finish wins and the other is cancelled or, if already running (always
+    the case with EvaluationPool.submit), left to finish and its result discarded.
+    stats counts the duplicates launched, those that won and the time they saved.
+    If `recover()` returns True (e.g. EvaluationPool.recover after a worker died),
+    every unfinished chunk is resubmitted.
+
+    A chunk that fails, or runs longer than `timeout` seconds, is resubmitted as
+    reseed(task, attempt) (e.g. with a fresh simulation seed) up to `retries` times before
+    run raises; failures, timeouts and retries are counted in stats. A timed-out copy is
+    left running unless `restart()` is given (e.g. EvaluationPool.restart), which is then
+    called to kill it before the retry: every unfinished chunk is resubmitted as well.'''
+    def __init__(self, submit, straggler_factor:float = None, poll_interval:float = 0.2, recover = None,
+                 timeout:float = None, retries:int = 0, reseed = None, restart = None):
+        self.submit = submit
+        self.straggler_factor = straggler_factor
+        self.poll_interval = poll_interval
+        self.recover = recover
+        self.timeout = timeout
+        self.retries = retries
+        self.reseed = reseed
+        self.restart = restart
+        self.stats = {'chunks': 0, 'speculative_launched': 0, 'speculative_won': 0, 'time_saved': 0.0,
+                      'failures': 0, 'timeouts': 0, 'retries': 0}
+
+    def _retry(self, i, tasks, attempts, launch):
+        if attempts[i] >= self.retries: return False
+        attempts[i] += 1
+        self.stats['retries'] += 1
+        if self.reseed is not None: tasks[i] = self.reseed(tasks[i], attempts[i])
+        launch(i)
+        return True
+
+    def _saved(self, t_win, future):
+        # the original copy of a chunk won by its duplicate has just finished
+        self.stats['time_saved'] += time.time() - t_win
+
+    def run(self, fn, tasks, slots:int = None, on_done = None):
+        '''Results of fn(task) for every task, in task order. on_done(task, result, seconds)
+        is called as each task finishes.'''
+        source = iter(tasks)
+        tasks, results, copies, attempts = [], [], [], []
+        owner, started, expired, handled, speculative = {}, {}, set(), set(), set()
+        def launch(i):
+            future = self.submit(fn, tasks[i])
+            owner[future], started[future] = i, time.time()
+            copies[i].append(future)
+        def pull():
+            task = next(source, StopIteration)
+            if task is StopIteration: return False
+            tasks.append(task)
+            results.append(None)
+            copies.append([])
+            attempts.append(0)
+            launch(len(tasks) - 1)
+            return True
+        exhausted = False
+        while not exhausted and (slots is None or len(tasks) < slots): exhausted = not pull()
+        done, durations = set(), []
+        while len(done) < len(tasks):
+            if self.recover is not None and self.recover():
+                for i in range(len(tasks)):
+                    if i in done: continue
+                    copies[i] = []
+                    launch(i)
+            pending = [f for i in range(len(tasks)) if i not in done for f in copies[i] if f not in handled]
+            finished, _ = wait(pending, timeout = self.poll_interval, return_when = FIRST_COMPLETED)
+            now = time.time()
+            for future in finished:
+                handled.add(future)
+                i = owner[future]
+                if i in done: continue
+                if future.exception() is not None:
+                    if any(not f.done() and f not in expired for f in copies[i]): continue  # another copy may still succeed
+                    self.stats['failures'] += 1
+                    print(f'Chunk {i} failed (attempt {attempts[i] + 1}): {future.exception()}')
+                    if not self._retry(i, tasks, attempts, launch): raise future.exception()
+                    continue
+                results[i] = future.result()
+                done.add(i)
+                durations.append(now - started[future])
+                if on_done is not None: on_done(tasks[i], results[i], durations[-1])
+                won_by_copy = future in speculative
+                if won_by_copy: self.stats['speculative_won'] += 1
+                for other in copies[i]:
+                    if other is future or other.done() or other.cancel(): continue
+                    if won_by_copy: other.add_done_callback(partial(self._saved, now))
+                if not exhausted: exhausted = not pull()
+            if self.timeout is not None:
+                timed_out = []
+                for i in range(len(tasks)):
+                    latest = copies[i][-1] if copies[i] else None
+                    if i in done or latest is None or latest.done() or latest in expired or now - started[latest] <= self.timeout: continue
+                    expired.add(latest)  # without restart, left running: its result is still used if it finishes first
+                    self.stats['timeouts'] += 1
+                    print(f'Chunk {i} timed out after {self.timeout}s (attempt {attempts[i] + 1})')
+                    if attempts[i] >= self.retries: raise TimeoutError(f'Chunk {i} timed out {attempts[i] + 1} times')
+                    timed_out.append(i)
+                if timed_out and self.restart is not None:
+                    self.restart()  # the hung copies would hold their workers forever
+                    for i in range(len(tasks)):
+                        if i in done or i in timed_out: continue
+                        copies[i] = []
+                        launch(i)
+                    for i in timed_out: copies[i] = []
+                for i in timed_out: self._retry(i, tasks, attempts, launch)
+            if not exhausted or self.straggler_factor is None or len(durations) < max(1, len(tasks) // 2): continue
+            limit = self.straggler_factor * median(durations)
+            for i in range(len(tasks)):
+                if i in done or len(copies[i]) > 1: continue
+                if now - started[copies[i][0]] > limit:
+                    launch(i)
+                    speculative.add(copies[i][-1])
+                    self.stats['speculative_launched'] += 1
+        self.stats['chunks'] += len(tasks)
+        return results
+
+
+class AdaptiveChunker():
+    '''On-demand (owner, (start, stop)) ranges over range(n) for each of n_owners candidates.
+
+    Used with ChunkExecutor.run(..., slots) as a work-stealing queue: instead of one equal
+    slice per core, ranges are cut as workers free up. Their size targets `target_time`
+    seconds from the muons/second measured on previous chunks (exponential average, kept
+    across evaluations), and never exceeds remaining / (2 * slots), so that chunks shrink
+    towards the end of an evaluation and all the workers finish together.
+    Owners are served round-robin, so every candidate progresses at the same pace.'''
+    def __init__(self, slots:int, target_time:float = 10.0, min_size:int = 1000, smoothing:float = 0.3):
+        self.slots = max(1, slots)
+        self.target_time = target_time
+        self.min_size = min_size
+        self.smoothing = smoothing
+        self.rate = None  # muons per second per chunk
+
+    def record(self, n_muons:int, seconds:float):
+        '''Update the throughput estimate with a finished chunk of n_muons.'''
+        if seconds <= 0 or n_muons <= 0: return
+        rate = n_muons / seconds
+        self.rate = rate if self.rate is None else (1 - self.smoothing) * self.rate + self.smoothing * rate
+
+    def size(self, remaining:int):
+        guided = -(-remaining // (2 * self.slots))
+        size = guided if self.rate is None else min(guided, int(self.rate * self.target_time))
+        return max(1, min(remaining, max(size, self.min_size)))
+
+    def ranges(self, spans):
+        '''Yield (owner, (start, stop)) chunks covering spans[owner], a list of (start, stop) intervals.'''
+        spans = [list(s) for s in spans]
+        remaining = sum(stop - start for s in spans for start, stop in s)
+        while remaining > 0:
+            for i, s in enumerate(spans):
+                if not s: continue
+                start, stop = s[0]
+                size = min(self.size(remaining), stop - start)
+                yield (i, (start, start + size))
+                remaining -= size
+                if start + size == stop: s.pop(0)
+                else: s[0] = (start + size, stop)